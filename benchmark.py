@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+'''
+cielcg benchmark - times applets against synthetic cgroupfs trees
+
+usage: python benchmark.py [--sizes 1000,10000] [--layout v1,v2] [--only lscgroup,cgget] [--json]
+       python benchmark.py --startup 50 [--startup-budget 10]
+
+trees are generated under a temporary directory (or --workdir) and passed to cielcg via SetCgroupMount().
+each benchmark runs in a forked child so that its peak RSS can be reported separately.
+'''
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import json
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cielcg
+
+V1_FILES = {
+    'cpu': {
+        'cpu.shares': '1024\n',
+        'cpu.cfs_period_us': '100000\n',
+        'cpu.cfs_quota_us': '-1\n',
+        'cpu.stat': 'nr_periods 0\nnr_throttled 0\nthrottled_time 0\n',
+    },
+    'memory': {
+        'memory.limit_in_bytes': '9223372036854771712\n',
+        'memory.soft_limit_in_bytes': '9223372036854771712\n',
+        'memory.usage_in_bytes': '1048576\n',
+        'memory.stat': 'cache 0\nrss 1048576\nmapped_file 0\nswap 0\n',
+    },
+    'pids': {
+        'pids.max': 'max\n',
+        'pids.current': '1\n',
+    },
+}
+V1_COMMON = {
+    'tasks': '',
+    'cgroup.procs': '',
+    'notify_on_release': '0\n',
+}
+V2_FILES = {
+    'cgroup.controllers': 'cpu io memory pids\n',
+    'cgroup.subtree_control': '\n',
+    'cgroup.procs': '',
+    'cgroup.events': 'populated 0\nfrozen 0\n',
+    'cpu.max': 'max 100000\n',
+    'cpu.weight': '100\n',
+    'cpu.stat': 'usage_usec 0\nuser_usec 0\nsystem_usec 0\n',
+    'memory.max': 'max\n',
+    'memory.high': 'max\n',
+    'memory.current': '1048576\n',
+    'memory.stat': 'anon 1048576\nfile 0\nkernel_stack 16384\n',
+    'memory.events': 'low 0\nhigh 0\nmax 0\noom 0\noom_kill 0\n',
+    'pids.max': 'max\n',
+    'pids.current': '1\n',
+    'io.stat': '',
+}
+
+# group i is a child of group (i-1)//fanout, so that the tree is balanced.
+def GroupPaths(count, fanout=10):
+    paths = ['bench']
+    for i in range(1, count):
+        paths.append('%s/g%d'%(paths[(i-1)//fanout], i))
+    return paths
+
+def WriteFiles(dir, files):
+    for name, cont in files.items():
+        with open(os.path.join(dir,name), 'w') as f:
+            f.write(cont)
+
+def MakeTree(root, layout, count, controlFiles=True):
+    paths = GroupPaths(count)
+    if layout == 'v1':
+        for typ in V1_FILES:
+            for path in paths:
+                os.makedirs(os.path.join(root,typ,path))
+                if controlFiles:
+                    WriteFiles(os.path.join(root,typ,path), V1_FILES[typ])
+                    WriteFiles(os.path.join(root,typ,path), V1_COMMON)
+    else:
+        with open(os.path.join(root,'cgroup.controllers'), 'w') as f:
+            f.write(V2_FILES['cgroup.controllers'])
+        for path in paths:
+            os.makedirs(os.path.join(root,path))
+            if controlFiles:
+                WriteFiles(os.path.join(root,path), V2_FILES)
+    return paths
+
+class NullOutput(object):
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+def benchLscgroup(root, layout, paths):
+    cielcg.main(NullOutput(), ['lscgroup'])
+    return len(paths)
+
+def benchCgget(root, layout, paths):
+    cielcg.main(NullOutput(), ['cgget']+paths)
+    return len(paths)
+
+def benchCopyFrom(root, layout, paths):
+    cielcg.main(NullOutput(), ['cgset', '--copy-from', paths[1]]+paths[2:])
+    return len(paths)-2
+
+def benchCgclassify(root, layout, paths):
+    npids = max(len(paths), 1000)
+    cielcg.main(NullOutput(), ['cgclassify', '-g', 'cpu:%s'%paths[1]]+[str(e) for e in range(1, npids+1)])
+    return npids
+
+def benchCgdelete(root, layout, paths):
+    # outside of cgroupfs rmdir fails on control files, so this benchmark uses a tree made of directories only
+    shutil.rmtree(root)
+    os.mkdir(root)
+    MakeTree(root, layout, len(paths), controlFiles=False)
+    if layout == 'v1':
+        argv = ['cgdelete', '-r']
+        for typ in V1_FILES:
+            argv += ['-g', '%s:bench'%typ]
+    else:
+        argv = ['cgdelete', '-r', '-g', ':bench']
+    start = time.time()
+    cielcg.main(NullOutput(), argv)
+    return len(paths), time.time()-start
+
+BENCHMARKS = [
+    ('lscgroup', benchLscgroup),
+    ('cgget', benchCgget),
+    ('cgset-copy-from', benchCopyFrom),
+    ('cgclassify', benchCgclassify),
+    ('cgdelete-r', benchCgdelete),
+]
+
+# runs fn in a forked child; returns (ops, seconds, maxrss_kb)
+def RunForked(fn, root, layout, paths):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            cielcg.SetCgroupMount(root, 1 if layout == 'v1' else 2)
+            start = time.time()
+            ret = fn(root, layout, paths)
+            if isinstance(ret, tuple):
+                ops, elapsed = ret
+            else:
+                ops, elapsed = ret, time.time()-start
+            os.write(wfd, json.dumps([ops, elapsed]).encode('utf-8'))
+            os._exit(0)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            os._exit(1)
+    os.close(wfd)
+    data = b''
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    _, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        return None
+    ops, elapsed = json.loads(data.decode('utf-8'))
+    return ops, elapsed, rusage.ru_maxrss
+
+# measures the wall time of launching `cgexec -g :/bench -- true` against the bare interpreter doing the same exec.
+# returns a list of (name, mean_ms, overhead_ms).
+def RunStartup(count):
+    workdir = tempfile.mkdtemp(prefix='cielcg-bench-')
+    try:
+        root = os.path.join(workdir, 'cgroup')
+        os.mkdir(root)
+        MakeTree(root, 'v2', 1)
+        env = dict(os.environ)
+        env['CIELCG_ROOT'] = root
+        env['PYTHONPATH'] = os.path.dirname(os.path.abspath(cielcg.__file__))
+        # the module form runs from the cached bytecode, so let it be written
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        script = os.path.abspath(cielcg.__file__).replace('.pyc', '.py')
+        bindir = os.path.join(workdir, 'bin')
+        os.mkdir(bindir)
+        subprocess.check_call([sys.executable, script, '--install'], cwd=bindir, env=env)
+        cmds = [
+            ('python', [sys.executable, '-c', 'import os; os.execvp("true", ["true"])']),
+            ('cielcg.py cgexec', [sys.executable, script, 'cgexec', '-g', ':/bench', '--', 'true']),
+            ('python -m cielcg cgexec', [sys.executable, '-m', 'cielcg', 'cgexec', '-g', ':/bench', '--', 'true']),
+            ('cgexec (--install)', [os.path.join(bindir, 'cgexec'), '-g', ':/bench', '--', 'true']),
+        ]
+        results = []
+        for name, cmd in cmds:
+            subprocess.check_call(cmd, env=env)
+            start = time.time()
+            for i in range(count):
+                subprocess.check_call(cmd, env=env)
+            results.append((name, (time.time()-start)*1000/count))
+        return [(name, ms, ms-results[0][1]) for name, ms in results]
+    finally:
+        shutil.rmtree(workdir)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchmark')
+    parser.add_argument('--sizes', default='1000', help='comma separated group counts (e.g. 1000,10000,100000)')
+    parser.add_argument('--layout', default='v1,v2', help='comma separated layouts (v1,v2)')
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--workdir', help='directory to generate trees in (default: temporary directory)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--startup', type=int, metavar='N', help='measure cgexec startup time over N launches instead')
+    parser.add_argument('--startup-budget', type=float, default=10.0, metavar='MS', help='fail if cgexec installed by --install takes more than MS over the bare interpreter (default: 10)')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        ret = 0
+        for name, ms, overhead in RunStartup(args.startup):
+            if args.json:
+                sys.stdout.write('%s\n'%json.dumps({'benchmark': 'startup', 'command': name, 'mean_ms': ms, 'overhead_ms': overhead}))
+            else:
+                sys.stdout.write('%-24s %8.2f ms (+%.2f ms)\n'%(name, ms, overhead))
+            # the budget applies to the launchers made by --install, which is what the applets are run as
+            if name == 'cgexec (--install)' and overhead > args.startup_budget:
+                sys.stderr.write('%s: startup overhead %.2f ms exceeds the budget of %.2f ms\n'%(name, overhead, args.startup_budget))
+                ret = 1
+        return ret
+
+    names = args.only.split(',') if args.only else [name for name, fn in BENCHMARKS]
+    if not args.json:
+        sys.stdout.write('%-6s %8s %-16s %10s %10s %12s %10s\n'%('layout', 'groups', 'benchmark', 'ops', 'seconds', 'ops/sec', 'maxrss_kb'))
+    ret = 0
+    for layout in args.layout.split(','):
+        for size in [int(e) for e in args.sizes.split(',')]:
+            for name, fn in BENCHMARKS:
+                if name not in names:
+                    continue
+                # each benchmark gets a fresh tree as some of them modify it
+                workdir = tempfile.mkdtemp(prefix='cielcg-bench-', dir=args.workdir)
+                try:
+                    root = os.path.join(workdir, 'cgroup')
+                    os.mkdir(root)
+                    paths = MakeTree(root, layout, size)
+                    result = RunForked(fn, root, layout, paths)
+                finally:
+                    shutil.rmtree(workdir)
+                if result is None:
+                    sys.stderr.write('%s %d %s failed\n'%(layout, size, name))
+                    ret = 1
+                    continue
+                ops, elapsed, maxrss = result
+                rate = ops/elapsed if elapsed > 0 else float('inf')
+                if args.json:
+                    sys.stdout.write('%s\n'%json.dumps({'layout': layout, 'groups': size, 'benchmark': name, 'ops': ops, 'seconds': elapsed, 'ops_per_sec': rate, 'maxrss_kb': maxrss}))
+                else:
+                    sys.stdout.write('%-6s %8d %-16s %10d %10.4f %12.1f %10d\n'%(layout, size, name, ops, elapsed, rate, maxrss))
+                sys.stdout.flush()
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
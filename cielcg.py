@@ -28,40 +28,122 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import sys
 import os
-import argparse
-import shutil
 import errno
+import struct
+
+# argparse and shutil take several milliseconds to import, which matters for cgexec on the job launch path.
+# they are imported by the functions which use them.
+
+def chown(path, user=None, group=None):
+    try:
+        from shutil import chown
+    except ImportError:
+        from backports.shutil_chown import chown
+    chown(path, user, group)
 
 try:
-    from shutil import chown
+    from os import scandir
 except ImportError:
-    from backports.shutil_chown import chown
+    try:
+        from scandir import scandir
+    except ImportError:
+        # minimal substitute for Python 2 without the scandir backport
+        class DirEntry(object):
+            def __init__(self, dir, name):
+                self.name = name
+                self.path = os.path.join(dir, name)
+            def is_symlink(self):
+                return os.path.islink(self.path)
+            def is_dir(self, follow_symlinks=True):
+                if not follow_symlinks and os.path.islink(self.path):
+                    return False
+                return os.path.isdir(self.path)
+            def is_file(self, follow_symlinks=True):
+                if not follow_symlinks and os.path.islink(self.path):
+                    return False
+                return os.path.isfile(self.path)
+            def stat(self, follow_symlinks=True):
+                return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+        def scandir(path):
+            return [DirEntry(path, name) for name in os.listdir(path)]
 
-cgrpath = cgrver = None
+cgrpath = cgrver = cgrtree = None
 def GetCgroupMount():
     global cgrpath, cgrver
     if cgrpath:
         return (cgrpath, cgrver)
+    if os.environ.get('CIELCG_ROOT'):
+        return SetCgroupMount(os.environ['CIELCG_ROOT'])
+    cache = os.environ.get('CIELCG_MOUNT_CACHE')
+    if cache:
+        mount = ReadMountCache(cache)
+        if mount is not None:
+            cgrpath, cgrver = mount
+            return (cgrpath, cgrver)
+    cgrpath, cgrver = ParseCgroupMount()
+    if cache:
+        WriteMountCache(cache, cgrpath, cgrver)
+    return (cgrpath, cgrver)
+
+def ParseCgroupMount():
     with open('/proc/mounts') as f:
         for line in f:
             dv, path, typ, opt, x, y = line.rstrip().split()
             if typ == 'cgroup':
-                cgrpath, cgrver = os.path.dirname(path), 1
-                return (cgrpath, cgrver)
+                return (os.path.dirname(path), 1)
         f.seek(0)
         for line in f:
             dv, path, typ, opt, x, y = line.rstrip().split()
             if typ == 'cgroup2':
-                cgrpath, cgrver = path, 2
-                return (cgrpath, cgrver)
+                return (path, 2)
     raise Exception('could not found cgroup path')
 
+# $CIELCG_MOUNT_CACHE names a file keeping the mount found in /proc/mounts across invocations.
+# the cache is used only while the layout of the path still matches its version.
+def ReadMountCache(cache):
+    try:
+        with open(cache) as f:
+            ver, path = f.read().rstrip('\n').split(' ',1)
+        ver = int(ver)
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.isdir(path) or os.path.isfile(os.path.join(path,'cgroup.controllers')) != (ver == 2):
+        return None
+    return (path, ver)
+
+def WriteMountCache(cache, path, ver):
+    try:
+        with open(cache+'.%d'%os.getpid(), 'w') as f:
+            f.write('%d %s\n'%(ver, path))
+        os.rename(cache+'.%d'%os.getpid(), cache)
+    except (IOError, OSError):
+        pass
+
+# use path as the cgroup root instead of the one in /proc/mounts (also settable by $CIELCG_ROOT).
+# ver is guessed from the layout if omitted, as cgroup.controllers exists only in v2.
+def SetCgroupMount(path, ver=None):
+    global cgrpath, cgrver, cgrtree
+    if ver is None:
+        ver = 2 if os.path.isfile(os.path.join(path,'cgroup.controllers')) else 1
+    cgrpath, cgrver = path.rstrip('/') or '/', ver
+    cgrtree = None
+    return (cgrpath, cgrver)
+
 def ConvertToInt(val):
     try:
         return int(val)
     except ValueError:
         return val
 
+def ReadKeyed(path):
+    values = {}
+    with open(path) as f:
+        for line in f:
+            cols = line.split()
+            if len(cols) == 2:
+                values[cols[0]] = ConvertToInt(cols[1])
+    return values
+
 def makedirs(name, mode=0o777, exist_ok=False):
     if not exist_ok:
         os.makedirs(name,mode=mode)
@@ -74,368 +156,1815 @@ def makedirs(name, mode=0o777, exist_ok=False):
             if e.errno!=errno.EEXIST:
                 raise
 
-def rmdirs(path):
-    for curDir, dirs, files in os.walk(path, topdown=False):
-        for dir in dirs:
-            if not os.path.islink(os.path.join(curDir, dir)):
-                os.rmdir(os.path.join(curDir, dir))
-    os.rmdir(path)
+# rmdir(2) retrying EBUSY (e.g. a group whose last tasks are still exiting) with exponential backoff.
+# returns None on success (or if path is already gone), otherwise the errno of the last attempt.
+def RemoveDir(path, retries=5, backoff=0.01):
+    import time
+    for i in range(retries+1):
+        try:
+            os.rmdir(path)
+            return None
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            if e.errno != errno.EBUSY or i == retries:
+                return e.errno
+        time.sleep(min(backoff * (1<<i), 1.0))
+
+# {depth: [directories]} of the directories in tops (depth 0) and all their subdirectories, from a single walk.
+def TreeLevels(tops):
+    levels = {}
+    for top in tops:
+        top = top.rstrip('/')
+        if not os.path.isdir(top):
+            continue
+        levels.setdefault(0, []).append(top)
+        for path in WalkCgroup(top, top):
+            levels.setdefault(path.count('/')-top.count('/'), []).append(path)
+    return levels
+
+# removes the directories in tops with all their subdirectories. see RemoveLevels().
+def RemoveTree(tops, jobs=1, retries=5, backoff=0.01):
+    return RemoveLevels(TreeLevels(tops), jobs, retries, backoff)
+
+# removes the directories of levels (see TreeLevels()), deepest level first. each level is removed
+# on a pool of jobs threads; parents of a directory which could not be removed are reported without trying.
+# returns (number of removed directories, [(path, errno)]).
+def RemoveLevels(levels, jobs=1, retries=5, backoff=0.01):
+    removed, failures, blocked = 0, [], set()
+    def remove(path):
+        if path in blocked:
+            return errno.ENOTEMPTY
+        return RemoveDir(path, retries, backoff)
+    for level in sorted(levels, reverse=True):
+        paths = levels[level]
+        for path, err in zip(paths, ParallelMap(remove, paths, jobs)):
+            if err is None:
+                removed += 1
+            else:
+                failures.append((path, err))
+                blocked.add(os.path.dirname(path))
+    return removed, failures
+
+# pids in cgroup.procs of dirs.
+def ReadProcs(dirs):
+    pids = set()
+    for dir in dirs:
+        try:
+            pids.update(int(e) for e in ReadControlFile(os.path.join(dir,'cgroup.procs')).split())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return pids
+
+# pids in cgroup.procs of dirs and all their subdirectories.
+def SubtreeProcs(dirs):
+    return ReadProcs(dir for top in dirs for dir in [top]+list(WalkCgroup(top, top)))
+
+# moves the processes in cgroup.procs of dirs to the directory target, repeating while some get moved as they
+# may be forking. returns (number of moved pids, [(pid, errno)] which could not be moved).
+def MigrateProcs(dirs, target):
+    fd = None
+    moved = 0
+    try:
+        while True:
+            pids = ReadProcs(dirs)
+            if not pids:
+                return moved, []
+            if fd is None:
+                fd = os.open(os.path.join(target,'cgroup.procs'), os.O_WRONLY|os.O_APPEND)
+            failed = ClassifyPids(fd, sorted(pids))
+            moved += len(pids)-len(failed)
+            if len(failed) == len(pids):
+                return moved, failed
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+try:
+    intern = sys.intern
+except AttributeError:
+    pass
+
+# index of the directories of a hierarchy below top and of the control file names of each (see CgroupTree.use_index()).
+# nodes are kept in preorder in parallel arrays, so that the subtree of node i is the nodes i to ends[i]-1. file names are
+# interned and a list of them (with the cgroup.controllers it was seen with in v2) is stored once in sets and shared by the
+# groups having it. cgroupfs does not update the mtime of a directory when a group is made or removed in it, but st_nlink
+# counts its subdirectories and the inode number of a group is not reused, so refresh() lstat()s each directory and lists
+# again only those whose (inode, nlink, mtime) changed.
+class HierarchyIndex(object):
+    __slots__ = ['top', 'names', 'ends', 'inos', 'nlinks', 'mtimes', 'filesets', 'sets', 'validated', 'childmaps']
+
+    def __init__(self, top, data=None):
+        import array
+        self.top = top
+        self.childmaps = {}
+        if data is None:
+            self.names, self.sets, self.validated = [], [], None
+            self.ends, self.inos, self.nlinks, self.mtimes, self.filesets = array.array('l'), array.array('L'), array.array('L'), array.array('d'), array.array('l')
+            return
+        self.validated, names, ends, inos, nlinks, mtimes, filesets, sets = data
+        self.names = [intern(e) for e in names.split('\0')] if names else []
+        self.sets = [(controllers, tuple(intern(e) for e in files)) for controllers, files in sets]
+        self.ends, self.inos, self.nlinks, self.mtimes, self.filesets = [array.array(typ) for typ in 'lLLdl']
+        for arr, raw in zip([self.ends, self.inos, self.nlinks, self.mtimes, self.filesets], [ends, inos, nlinks, mtimes, filesets]):
+            getattr(arr, 'frombytes', getattr(arr, 'fromstring', None))(raw)
+
+    # data for HierarchyIndex(top, data), made of builtin types for marshal.
+    def dump(self):
+        arrays = [getattr(arr, 'tobytes', getattr(arr, 'tostring', None))() for arr in [self.ends, self.inos, self.nlinks, self.mtimes, self.filesets]]
+        # a single string loads much faster than a list of them
+        return tuple([self.validated, '\0'.join(self.names)]+arrays+[self.sets])
+
+    # brings the index up to date with the file system. returns whether anything changed.
+    def refresh(self):
+        import array
+        import time
+        old = (self.names, self.ends, self.inos, self.nlinks, self.mtimes, self.filesets, self.sets)
+        oldnames, oldends, oldinos, oldnlinks, oldmtimes, oldfilesets, oldsets = old
+        names, sets, setids = [], [], {}
+        ends, inos, nlinks, mtimes, filesets = [array.array(typ) for typ in 'lLLdl']
+        changed = []
+        def add(name, st, fileset):
+            id = setids.get(fileset)
+            if id is None:
+                id = setids[fileset] = len(sets)
+                sets.append(fileset)
+            names.append(name)
+            ends.append(0)
+            inos.append(st.st_ino)
+            nlinks.append(st.st_nlink)
+            mtimes.append(st.st_mtime)
+            filesets.append(id)
+            return len(names)-1
+        # lists path; subdirectories which are in oldchildren ({name: old node}) are merged, the others scanned.
+        def scan(path, name, st, oldchildren):
+            dirs, files = [], []
+            try:
+                for ent in scandir(path):
+                    if ent.is_dir(follow_symlinks=False):
+                        dirs.append(ent.name)
+                    else:
+                        files.append(intern(ent.name))
+                controllers = ReadControlFile(path+'/cgroup.controllers') if 'cgroup.controllers' in files else None
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            i = add(name, st, (controllers, tuple(sorted(files))))
+            for e in dirs:
+                if e in oldchildren:
+                    merge(oldchildren[e], path+'/'+e, oldnames[oldchildren[e]])
+                    continue
+                try:
+                    cst = os.lstat(path+'/'+e)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    continue
+                scan(path+'/'+e, intern(e), cst, {})
+            ends[i] = len(names)
+        def merge(j, path, name):
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                changed.append(path)
+                return False
+            if st.st_ino != oldinos[j]:
+                changed.append(path)
+                scan(path, name, st, {})
+            elif st.st_nlink != oldnlinks[j] or st.st_mtime != oldmtimes[j]:
+                changed.append(path)
+                oldchildren = {}
+                k = j+1
+                while k < oldends[j]:
+                    oldchildren[oldnames[k]] = k
+                    k = oldends[k]
+                scan(path, name, st, oldchildren)
+            else:
+                i = add(name, st, oldsets[oldfilesets[j]])
+                gone, childnames = False, set()
+                k = j+1
+                while k < oldends[j]:
+                    childnames.add(oldnames[k])
+                    gone = not merge(k, path+'/'+oldnames[k], oldnames[k]) or gone
+                    k = oldends[k]
+                if gone:
+                    # the same count of subdirectories with one gone means another one was made (or renamed)
+                    for ent in scandir(path):
+                        if ent.name not in childnames and ent.is_dir(follow_symlinks=False):
+                            try:
+                                scan(ent.path, intern(ent.name), os.lstat(ent.path), {})
+                            except OSError as e:
+                                if e.errno != errno.ENOENT:
+                                    raise
+                ends[i] = len(names)
+            return True
+        if oldnames:
+            merge(0, self.top, '')
+        else:
+            changed.append(self.top)
+            scan(self.top, '', os.lstat(self.top), {})
+        self.names, self.ends, self.inos, self.nlinks, self.mtimes, self.filesets, self.sets = names, ends, inos, nlinks, mtimes, filesets, sets
+        self.childmaps = {}
+        self.validated = time.time()
+        return bool(changed)
+
+    # node of the directory rel (relative to top, '' for top itself), or None.
+    def find(self, rel):
+        i = 0
+        if not self.names:
+            return None
+        for name in rel.split('/'):
+            if not name:
+                continue
+            children = self.childmaps.get(i)
+            if children is None:
+                children = self.childmaps[i] = {}
+                j = i+1
+                while j < self.ends[i]:
+                    children[self.names[j]] = j
+                    j = self.ends[j]
+            i = children.get(name)
+            if i is None:
+                return None
+        return i
+
+    # sorted control file names of the directory rel, with the cgroup.controllers they were listed with (v2; otherwise
+    # None), or None if it is not in the index.
+    def files(self, rel):
+        i = self.find(rel)
+        return None if i is None else self.sets[self.filesets[i]]
+
+    # WalkCgroup() of the directory rel over the index.
+    def walk(self, rel, prefix='', depth=None, patterns=None):
+        patterns, states = GlobStart(patterns, prefix)
+        i = self.find(rel)
+        if i is None or patterns and not states:
+            return
+        names, ends = self.names, self.ends
+        stack = [(i, prefix, 1, states)]
+        while stack:
+            i, rel, level, states = stack.pop()
+            children = []
+            j = i+1
+            while j < ends[i]:
+                path = rel+'/'+names[j]
+                nstates = None
+                if patterns:
+                    nstates = GlobStep(patterns, states, names[j])
+                    if not nstates:
+                        j = ends[j]
+                        continue
+                    if GlobMatched(patterns, nstates):
+                        yield path
+                else:
+                    yield path
+                if depth is None or level < depth:
+                    children.append((j, path, level+1, nstates))
+                j = ends[j]
+            children.reverse()
+            stack.extend(children)
+
+# {top: data of HierarchyIndex} of the cache file, or {} if it is missing or was written by another Python.
+indexFormat = 1
+def ReadIndexCache(cache):
+    import marshal
+    try:
+        with open(cache, 'rb') as f:
+            data = marshal.load(f)
+        if data[0] != (indexFormat,)+tuple(sys.version_info[:2]):
+            return {}
+        return data[1]
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+        return {}
+
+def WriteIndexCache(cache, tops):
+    import marshal
+    try:
+        with open(cache+'.%d'%os.getpid(), 'wb') as f:
+            marshal.dump(((indexFormat,)+tuple(sys.version_info[:2]), tops), f)
+        os.rename(cache+'.%d'%os.getpid(), cache)
+    except (IOError, OSError):
+        pass
+
+# like map(), but fn is run on a pool of jobs threads. results are yielded in the order of items,
+# and at most a few items per thread are in flight so that a long iterable is not consumed at once.
+def ParallelMap(fn, items, jobs=1):
+    executor = None
+    if jobs > 1:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=jobs)
+        except ImportError:
+            pass
+    if executor is None:
+        for item in items:
+            yield fn(item)
+        return
+    import collections
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= jobs*4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+# glob patterns are matched per path component; '**' matches any number of components.
+# a state is (pattern index, component index); walking a directory steps the states by its name,
+# and a subtree is pruned as soon as no state is left.
+def GlobClosure(patterns, states):
+    states = set(states)
+    stack = list(states)
+    while stack:
+        p, i = stack.pop()
+        if i < len(patterns[p]) and patterns[p][i] == '**' and (p, i+1) not in states:
+            states.add((p, i+1))
+            stack.append((p, i+1))
+    return states
+
+def GlobStep(patterns, states, name):
+    import fnmatch
+    nstates = []
+    for p, i in states:
+        if i < len(patterns[p]):
+            if patterns[p][i] == '**':
+                nstates.append((p, i))
+            elif fnmatch.fnmatchcase(name, patterns[p][i]):
+                nstates.append((p, i+1))
+    return GlobClosure(patterns, nstates)
+
+def GlobMatched(patterns, states):
+    for p, i in states:
+        if i == len(patterns[p]):
+            return True
+    return False
+
+# (split patterns, states after the components of prefix) for WalkCgroup(); (None, None) without patterns.
+def GlobStart(patterns, prefix):
+    if not patterns:
+        return None, None
+    patterns = [[e for e in pattern.split('/') if e] for pattern in patterns]
+    states = GlobClosure(patterns, [(p, 0) for p in range(len(patterns))])
+    for name in prefix.split('/'):
+        if name and states:
+            states = GlobStep(patterns, states, name)
+    return patterns, states
+
+# yields descendant groups of top (not top itself) as prefix+'/'+relative path, parents before children.
+# depth limits how many levels below top are visited; patterns (list of glob strings) are matched
+# against the yielded path, and subtrees which cannot match are not scanned at all.
+def WalkCgroup(top, prefix='', depth=None, patterns=None):
+    patterns, states = GlobStart(patterns, prefix)
+    if patterns and not states:
+        return
+    stack = [(top, prefix, 1, states)]
+    while stack:
+        dir, rel, level, states = stack.pop()
+        try:
+            entries = scandir(dir)
+        except OSError as e:
+            # removed while walking
+            if e.errno==errno.ENOENT:
+                continue
+            raise
+        children = []
+        for ent in entries:
+            if not ent.is_dir(follow_symlinks=False):
+                continue
+            path = rel+'/'+ent.name
+            nstates = None
+            if patterns:
+                nstates = GlobStep(patterns, states, ent.name)
+                if not nstates:
+                    continue
+                if GlobMatched(patterns, nstates):
+                    yield path
+            else:
+                yield path
+            if depth is None or level < depth:
+                children.append((ent.path, path, level+1, nstates))
+        children.reverse()
+        stack.extend(children)
+
+# files whose values the kernel rounds down to pages, and the value read back for "no limit" in v1.
+pageRoundedFiles = ['memory.max', 'memory.high', 'memory.low', 'memory.min', 'memory.swap.max', 'memory.limit_in_bytes', 'memory.soft_limit_in_bytes', 'memory.memsw.limit_in_bytes']
+v1Unlimited = str((1<<63)-4096)
+
+# "major:minor" of a block device given as such, as /dev/sda or as sda. lookups are cached.
+deviceNumbers = {}
+def DeviceNumber(dev):
+    if dev not in deviceNumbers:
+        if ':' in dev:
+            deviceNumbers[dev] = dev
+        else:
+            st = os.stat(dev if dev.startswith('/') else os.path.join('/dev',dev))
+            deviceNumbers[dev] = '%d:%d'%(os.major(st.st_rdev), os.minor(st.st_rdev))
+    return deviceNumbers[dev]
+
+# readers take the contents of the v2 files of a table entry and return the v1 representation;
+# writers take the same contents and a v1 value and return the new content of the first file.
+def ReadField(index, maxval=None):
+    def read(conts):
+        val = conts[0].split()[index]
+        return maxval if val == 'max' and maxval is not None else val
+    return read
+
+def ReplaceField(index, maxval=None):
+    def write(conts, val):
+        cols = conts[0].split()
+        cols[index] = 'max' if val == maxval else val
+        return ' '.join(cols)
+    return write
+
+def ReadLimit(conts):
+    val = conts[0].strip()
+    return v1Unlimited if val == 'max' else val
+
+# bytes of a memory size with an optional K/M/G/T/P/E suffix (as the kernel's memparse() accepts), or None.
+def MemParse(val):
+    val = val.strip()
+    shift = 'kmgtpe'.find(val[-1:].lower())+1 if val else 0
+    digits = val[:-1] if shift else val
+    if not digits.isdigit():
+        return None
+    return int(digits) << (10*shift)
+
+# only plain numbers are compared with the v1 "unlimited" value; others (e.g. "1G") are passed to the kernel as they are
+def WriteLimit(conts, val):
+    return 'max' if val in ['-1', 'max'] or val.isdigit() and int(val) >= int(v1Unlimited) else val
+
+# memory.memsw (memory+swap) against memory.swap.max (swap only), relative to memory.max
+def ReadMemsw(conts):
+    swap, mem = conts[0].strip(), conts[1].strip()
+    return v1Unlimited if 'max' in [swap, mem] else str(int(swap)+int(mem))
+
+def WriteMemsw(conts, val):
+    mem = conts[1].strip()
+    if val in ['-1', 'max'] or val.isdigit() and int(val) >= int(v1Unlimited):
+        return 'max'
+    total, limit = MemParse(val), MemParse(mem)
+    if total is None or limit is None or total < limit:
+        # v1 does not allow memsw below (or without) the memory limit either
+        raise ValueError(val)
+    return str(total-limit)
+
+# blkio.throttle.* files have a "major:minor value" line per limited device; io.max has all 4 limits in a line.
+ioMaxFields = ['rbps', 'wbps', 'riops', 'wiops']
+def ReadIoMax(field):
+    def read(conts):
+        lines = []
+        for line in conts[0].splitlines():
+            cols = line.split()
+            for col in cols[1:]:
+                name, _, val = col.partition('=')
+                if name == field and val != 'max':
+                    lines.append('%s %s'%(cols[0], val))
+        return '\n'.join(lines)
+    return read
+
+def WriteIoMax(field):
+    def write(conts, val):
+        lines = conts[0].splitlines()
+        for spec in val.splitlines():
+            dev, limit = spec.split()
+            dev = DeviceNumber(dev)
+            limit = 'max' if limit == '0' else str(int(limit))
+            for i, line in enumerate(lines):
+                cols = line.split()
+                if cols and cols[0] == dev:
+                    lines[i] = ' '.join([dev]+[field+'='+limit if col.startswith(field+'=') else col for col in cols[1:]])
+                    break
+            else:
+                lines.append(' '.join([dev]+['%s=%s'%(name, limit if name == field else 'max') for name in ioMaxFields]))
+        return '\n'.join(lines)
+    return write
+
+# blkio.weight (10..1000, default 500) against the "default" line of io.weight (1..10000, default 100).
+# scaled around the defaults like systemd does (io = blkio*100/500), so that the default maps to the default.
+def ReadIoWeight(conts):
+    for line in conts[0].splitlines():
+        cols = line.split()
+        if cols[0] == 'default':
+            return '%d'%max(10, min(1000, int(cols[1]) * 500 // 100))
+    raise ValueError(conts[0])
+
+def WriteIoWeight(conts, val):
+    lines = [line for line in conts[0].splitlines() if line.split()[0] != 'default']
+    return '\n'.join(['default %d'%max(1, min(10000, int(val) * 100 // 500))]+lines)
+
+# v1 variables emulated on top of v2 files: key -> (v2 files, reader, writer or None if read only).
+# the first file is the one written; the others are only read (e.g. memory.max for memory.memsw.limit_in_bytes).
+# pids.* and cpuset.cpus/mems have the same names and formats in v2, so they are not listed.
+cgroup2Table = {
+    'cpu.cfs_period_us':              (('cpu.max',), ReadField(1), ReplaceField(1)),
+    'cpu.cfs_quota_us':               (('cpu.max',), ReadField(0, '-1'), ReplaceField(0, '-1')),
+    'cpu.cfs_burst_us':               (('cpu.max.burst',), lambda conts: conts[0].strip(), lambda conts, val: val),
+    'cpu.rt_period_us':               (('cpu.rt.max',), ReadField(1), ReplaceField(1)),
+    'cpu.rt_runtime_us':              (('cpu.rt.max',), ReadField(0, '-1'), ReplaceField(0, '-1')),
+    'cpu.shares':                     (('cpu.weight',), lambda conts: '%d'%(1024 * int(conts[0]) // 100), lambda conts, val: '%d'%max(1, min(10000, int(val) * 100 // 1024))),
+    'memory.limit_in_bytes':          (('memory.max',), ReadLimit, WriteLimit),
+    'memory.soft_limit_in_bytes':     (('memory.high',), ReadLimit, WriteLimit),
+    'memory.usage_in_bytes':          (('memory.current',), lambda conts: conts[0].strip(), None),
+    'memory.max_usage_in_bytes':      (('memory.peak',), lambda conts: conts[0].strip(), None),
+    'memory.memsw.limit_in_bytes':    (('memory.swap.max', 'memory.max'), ReadMemsw, WriteMemsw),
+    'memory.memsw.usage_in_bytes':    (('memory.swap.current', 'memory.current'), lambda conts: str(int(conts[0])+int(conts[1])), None),
+    'blkio.weight':                   (('io.weight',), ReadIoWeight, WriteIoWeight),
+    'blkio.throttle.read_bps_device':  (('io.max',), ReadIoMax('rbps'), WriteIoMax('rbps')),
+    'blkio.throttle.write_bps_device': (('io.max',), ReadIoMax('wbps'), WriteIoMax('wbps')),
+    'blkio.throttle.read_iops_device': (('io.max',), ReadIoMax('riops'), WriteIoMax('riops')),
+    'blkio.throttle.write_iops_device':(('io.max',), ReadIoMax('wiops'), WriteIoMax('wiops')),
+    'cpuset.effective_cpus':          (('cpuset.cpus.effective',), lambda conts: conts[0].strip(), None),
+    'cpuset.effective_mems':          (('cpuset.mems.effective',), lambda conts: conts[0].strip(), None),
+    'cpuset.cpu_exclusive':           (('cpuset.cpus.partition',), lambda conts: '1' if conts[0].split()[0] == 'root' else '0', lambda conts, val: 'root' if val == '1' else 'member'),
+}
+
+# content of file in dir through cache ({file: content or None if not readable}), so that a v2 file is read once
+# however many v1 keys map to it.
+def ReadCached(cache, dir, file):
+    if file not in cache:
+        try:
+            cache[file] = ReadControlFile(os.path.join(dir,file))
+        except (IOError, OSError):
+            cache[file] = None
+    return cache[file]
+
+# Cgroup2Read returns the value in v1 representation, or None if key is not converted (or the v2 file is missing).
+# pass the same cache for the keys of a group to read each v2 file at most once.
+def Cgroup2Read(dir, key, cache=None):
+    if key not in cgroup2Table:
+        return None
+    if cache is None:
+        cache = {}
+    files, read, write = cgroup2Table[key]
+    conts = [ReadCached(cache, dir, file) for file in files]
+    if None in conts:
+        return None
+    return read(conts)
+
+# content of a control file read with os.open()/os.read(), which is cheaper than a buffered text file object
+# when many small files are read once.
+def ReadControlFile(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        os.close(fd)
+    return b''.join(chunks).decode('utf-8', 'replace')
+
+# readable and writable files whose content cannot be written back (or which are writable only to reset counters).
+unsettableFiles = ['tasks', 'notify_on_release', 'release_agent', 'memory.oom_control', 'cpuacct.usage']
+unsettableSuffixes = ('.pressure', '.failcnt', '.max_usage_in_bytes', '.peak')
+
+# whether writing new to the file would leave cur (its content) unchanged.
+def SameValue(file, cur, new):
+    cur, new = cur.split(), new.split()
+    if cur == new:
+        return True
+    if file in pageRoundedFiles and len(cur) == 1 and len(new) == 1:
+        if new[0] == '-1':
+            return cur[0] in ['max', v1Unlimited]
+        try:
+            pagesize = os.sysconf('SC_PAGESIZE')
+            return int(cur[0]) == int(new[0]) // pagesize * pagesize
+        except ValueError:
+            return False
+    return False
+
+# cgroup.procs accepts a single pid per write(2), so pids are written one by one into the opened fd.
+# returns a list of (pid, errno) which could not be moved instead of aborting at the first failure.
+def ClassifyPids(fd, pids):
+    failures = []
+    for pid in pids:
+        try:
+            os.write(fd, ('%d\n'%pid).encode('ascii'))
+        except OSError as e:
+            failures.append((pid, e.errno))
+    return failures
+
+# yields lists of at most batchsize pids from whitespace separated text in f.
+# tokens which are not numbers are reported to stderr and skipped (and appended to invalid if given).
+def ReadPidBatches(f, batchsize=4096, invalid=None):
+    batch = []
+    for line in f:
+        for token in line.split():
+            try:
+                batch.append(int(token))
+            except ValueError:
+                sys.stderr.write('invalid pid: %s\n'%token)
+                if invalid is not None:
+                    invalid.append(token)
+                continue
+            if len(batch) >= batchsize:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def ParseOwner(owner):
+    if owner is None:
+        return None
+    uid, gid = owner.split(':')
+    return (ConvertToInt(uid), ConvertToInt(gid))
+
+# (uid, gid) with user and group names looked up, so that chown() does not resolve them for every file.
+def ResolveOwner(owner):
+    if owner is None:
+        return None
+    uid, gid = owner
+    if uid is not None and not isinstance(uid, int):
+        import pwd
+        uid = pwd.getpwnam(uid).pw_uid
+    if gid is not None and not isinstance(gid, int):
+        import grp
+        gid = grp.getgrnam(gid).gr_gid
+    return (uid, gid)
+
+CLONE_INTO_CGROUP = 0x200000000
+SYS_clone3 = 435
+
+# creates a child process which starts in the v2 group opened as dirfd, so that no migration is needed
+# (and nothing is charged to the parent's group). returns the pid like fork(),
+# or None if the kernel does not support clone3(CLONE_INTO_CGROUP) (< 5.7).
+# the syscall is made through PyDLL, which keeps the GIL held as os.fork() does: with CDLL another thread could take it
+# at the moment of the clone, and the child would deadlock waiting for it.
+def CloneIntoCgroup(dirfd):
+    import ctypes
+    import signal
+    class CloneArgs(ctypes.Structure):
+        _fields_ = [(name, ctypes.c_uint64) for name in ['flags', 'pidfd', 'child_tid', 'parent_tid', 'exit_signal', 'stack', 'stack_size', 'tls', 'set_tid', 'set_tid_size', 'cgroup']]
+    libc = ctypes.PyDLL(None, use_errno=True)
+    libc.syscall.restype = ctypes.c_long
+    api = ctypes.pythonapi
+    # os.register_at_fork() hooks and the import lock (Python 3.7+)
+    hooks = hasattr(api, 'PyOS_BeforeFork')
+    args = CloneArgs(flags=CLONE_INTO_CGROUP, exit_signal=signal.SIGCHLD, cgroup=dirfd)
+    if hooks:
+        api.PyOS_BeforeFork()
+    pid = libc.syscall(ctypes.c_long(SYS_clone3), ctypes.byref(args), ctypes.c_size_t(ctypes.sizeof(args)))
+    if pid == 0:
+        # the same as what os.fork() does in the child
+        if hasattr(api, 'PyOS_AfterFork_Child'):
+            api.PyOS_AfterFork_Child()
+        else:
+            api.PyOS_AfterFork()
+        return pid
+    if hooks:
+        api.PyOS_AfterFork_Parent()
+    if pid < 0:
+        err = ctypes.get_errno()
+        if err in [errno.ENOSYS, errno.E2BIG, errno.EINVAL]:
+            return None
+        raise OSError(err, os.strerror(err))
+    return pid
+
+# in a forked child; never returns.
+def ExecChild(cmd):
+    try:
+        os.execvp(cmd[0], cmd)
+    except OSError as e:
+        sys.stderr.write('%s: %s\n'%(cmd[0], e.strerror))
+    finally:
+        os._exit(127)
+
+# waits for pid and returns its exit status like a shell does (128+signal if killed).
+def WaitChild(pid):
+    while True:
+        try:
+            pid, status = os.waitpid(pid, 0)
+            break
+        except OSError as e:
+            if e.errno!=errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        return 128+os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+# waits until one of the child processes in pids (a collection) exits and returns (pid, status) of os.waitpid(), or
+# (0, 0) if interrupted. pidfds ({pid: pidfd}) are waited for with select; pids without one are polled with a backoff
+# of up to poll seconds.
+def WaitAnyChild(pids, pidfds={}, poll=0.01):
+    import select
+    import time
+    fds = [pidfds[pid] for pid in pids if pid in pidfds]
+    delay = 0.0005
+    while True:
+        for pid in pids:
+            try:
+                found, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                return 0, 0
+            if found:
+                return found, status
+        try:
+            if len(fds) == len(pids):
+                select.select(fds, [], [])
+            else:
+                time.sleep(delay)
+                delay = min(delay*2, poll)
+        except (select.error, OSError, IOError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return 0, 0
+
+# a cgroup hierarchy (v1: directory containing one mount per controller, v2: the unified mount).
+# the controller list is resolved once and cached; call refresh() after mounting/unmounting controllers.
+class CgroupTree(object):
+    def __init__(self, root=None, version=None):
+        if root is None:
+            root, version = GetCgroupMount()
+        elif version is None:
+            version = 2 if os.path.isfile(os.path.join(root,'cgroup.controllers')) else 1
+        if version not in [1, 2]:
+            raise NotImplementedError('unknown cgroup version %d'%version)
+        self.root = root.rstrip('/') or '/'
+        self.version = version
+        self._controllers = None
+        self.indexes = None
+
+    def __repr__(self):
+        return 'CgroupTree(%r, %d)'%(self.root, self.version)
+
+    def refresh(self):
+        self._controllers = None
+
+    @property
+    def controllers(self):
+        if self._controllers is None:
+            if self.version == 1:
+                self._controllers = sorted(e for e in os.listdir(self.root) if os.path.isdir(os.path.join(self.root,e)) and not os.path.islink(os.path.join(self.root,e)))
+            else:
+                with open(os.path.join(self.root,'cgroup.controllers')) as f:
+                    self._controllers = f.read().split()
+        return self._controllers
+
+    # makes walk() and Cgroup.values() use a HierarchyIndex of each hierarchy instead of listing directories. with cache, the
+    # indexes are kept in the file across processes; an index is used without revalidation for ttl seconds after it was
+    # refreshed (by any process), and refreshed otherwise.
+    def use_index(self, cache=None, ttl=0):
+        self.indexes = {}
+        self.indexCache = cache
+        self.indexTtl = ttl
+        self.indexData = ReadIndexCache(cache) if cache else {}
+
+    # HierarchyIndex of the hierarchy at top (the root in v2, a controller directory in v1), or None without use_index().
+    def index(self, top):
+        import time
+        if self.indexes is None:
+            return None
+        index = self.indexes.get(top)
+        if index is None:
+            index = self.indexes[top] = HierarchyIndex(top, self.indexData.get(top))
+        if index.validated is None or time.time()-index.validated >= self.indexTtl:
+            index.refresh()
+            if self.indexCache:
+                self.indexData[top] = index.dump()
+                WriteIndexCache(self.indexCache, self.indexData)
+        return index
+
+    # sorted names of the files (not directories) in the group directory dir.
+    def files(self, dir):
+        if self.indexes is not None:
+            top = self.root if self.version == 2 else os.path.join(self.root,os.path.relpath(dir, self.root).split('/')[0])
+            entry = self.index(top).files(os.path.relpath(dir, top) if dir != top else '')
+            # in v2 the control files of a group change with the controllers enabled for it
+            if entry is not None and (entry[0] is None or entry[0] == ReadControlFile(os.path.join(dir,'cgroup.controllers'))):
+                return entry[1]
+        return sorted(ent.name for ent in scandir(dir) if ent.is_file())
+
+    def group(self, path, controllers=None):
+        return Cgroup(self, path, controllers)
+
+    # yields descendant Cgroups of path (see WalkCgroup). in v1 each controller hierarchy is walked separately
+    # and the yielded groups have a single controller; jobs>1 walks them on a thread pool.
+    def walk(self, path='/', controllers=None, depth=None, patterns=None, jobs=1):
+        rel = path.strip('/')
+        prefix = '/'+rel if rel else ''
+        if self.version == 2:
+            if self.indexes is not None:
+                paths = self.index(self.root).walk(rel, prefix, depth, patterns)
+            else:
+                paths = WalkCgroup(os.path.join(self.root,rel), prefix, depth, patterns)
+            for e in paths:
+                yield Cgroup(self, e, controllers)
+            return
+        typs = [e for e in (controllers or self.controllers) if os.path.isdir(os.path.join(self.root,e))]
+        if self.indexes is not None:
+            for typ in typs:
+                for e in self.index(os.path.join(self.root,typ)).walk(rel, prefix, depth, patterns):
+                    yield Cgroup(self, e, [typ])
+            return
+        def walk(typ):
+            return [Cgroup(self, e, [typ]) for e in WalkCgroup(os.path.join(self.root,typ,rel), prefix, depth, patterns)]
+        if jobs > 1:
+            for grps in ParallelMap(walk, typs, jobs):
+                for grp in grps:
+                    yield grp
+        else:
+            for typ in typs:
+                for e in WalkCgroup(os.path.join(self.root,typ,rel), prefix, depth, patterns):
+                    yield Cgroup(self, e, [typ])
+
+    # creates the missing ancestors of the groups in entries ([(Cgroup, [(name, value), ...])]) and, in v2, enables the
+    # controllers of the groups (and of their values) in cgroup.subtree_control of every ancestor once, parents first.
+    # controllers already enabled are not written. returns [(directory, None, errno)] of the failures.
+    def prepare(self, entries, mode=0o755):
+        failed = []
+        ancestors = {}
+        for grp, values in entries:
+            enable = set()
+            if self.version == 2:
+                # v1 only controllers (e.g. cpuacct) have nothing to enable; writing them would fail the whole write
+                for e in grp.controllers or []:
+                    enable.update(typ for typ in e.split(',') if typ in self.controllers)
+                for key, val in values:
+                    file = cgroup2Table[key][0][0] if key in cgroup2Table else key
+                    if file.split('.')[0] in self.controllers:
+                        enable.add(file.split('.')[0])
+            for typ, dir in grp.dirs():
+                top = self.root if typ is None else os.path.join(self.root,typ)
+                while len(dir) > len(top):
+                    dir = os.path.dirname(dir)
+                    ancestors.setdefault(dir, set()).update(enable)
+        for dir in sorted(ancestors, key=lambda e: e.count('/')):
+            try:
+                if not os.path.isdir(dir):
+                    makedirs(dir, mode, exist_ok=True)
+                if ancestors[dir]:
+                    with open(os.path.join(dir,'cgroup.subtree_control'), 'r') as f:
+                        missing = sorted(ancestors[dir]-set(f.read().split()))
+                    if missing:
+                        with open(os.path.join(dir,'cgroup.subtree_control'), 'w') as f:
+                            f.write(' '.join('+'+e for e in missing))
+            except (IOError, OSError) as e:
+                failed.append((dir, None, e.errno))
+        return failed
+
+    # creates many groups at once (cgcreate -f). entries are [(Cgroup, [(name, value), ...])]; the values are applied
+    # as initial limits. after prepare(), the groups are created on a pool of jobs threads.
+    # user/group names of owner and task_owner are resolved once.
+    # returns {'created': number of groups, 'failed': [(path, name or None, errno)]}.
+    def create_many(self, entries, mode=0o755, owner=None, task_owner=None, task_perm=None, jobs=1):
+        owner, task_owner = ResolveOwner(owner), ResolveOwner(task_owner)
+        report = {'created': 0, 'failed': self.prepare(entries, mode)}
+        def create(entry):
+            grp, values = entry
+            try:
+                grp.create(mode, owner, task_owner, task_perm)
+            except (IOError, OSError) as e:
+                return [(grp.path, None, e.errno)]
+            written, skipped, failures = grp.update(values)
+            return [(grp.path, key, err) for key, err in failures]
+        for failures in ParallelMap(create, entries, jobs):
+            report['failed'].extend(failures)
+            if not failures or failures[0][1] is not None:
+                report['created'] += 1
+        return report
+
+# a group in a CgroupTree. controllers restricts the v1 hierarchies (directory names under the root) used,
+# or in v2 the control files listed by values(); None means all.
+class Cgroup(object):
+    def __init__(self, tree, path, controllers=None):
+        self.tree = tree
+        self.rel = path.strip('/')
+        self.path = '/'+self.rel
+        self.controllers = [e.lstrip('/') for e in controllers if e] if controllers else None
+
+    def __repr__(self):
+        return 'Cgroup(%r, %r)'%(self.path, self.controllers)
+
+    # list of (controller, directory); controller is None in v2.
+    def dirs(self):
+        if self.tree.version == 1:
+            return [(typ, os.path.join(self.tree.root,typ,self.rel) if self.rel else os.path.join(self.tree.root,typ)) for typ in (self.controllers or self.tree.controllers)]
+        return [(None, os.path.join(self.tree.root,self.rel) if self.rel else self.tree.root)]
+
+    # directory holding the file of key (v1: the hierarchy of its controller).
+    def dir(self, key):
+        if self.tree.version == 1:
+            typ = key.split('.')[0]
+            return os.path.join(self.tree.root,typ,self.rel) if self.rel else os.path.join(self.tree.root,typ)
+        return self.dirs()[0][1]
+
+    def exists(self):
+        return any(os.path.isdir(dir) for typ, dir in self.dirs())
+
+    def child(self, name):
+        return Cgroup(self.tree, self.path.rstrip('/')+'/'+name, self.controllers)
+
+    # owner and task_owner are (uid, gid) tuples of ids or names; task_perm is a mode like 0o664.
+    def create(self, mode=0o755, owner=None, task_owner=None, task_perm=None):
+        taskfiles = ['tasks', 'cgroup.procs'] if self.tree.version == 1 else ['cgroup.procs']
+        for typ, dir in self.dirs():
+            makedirs(dir,mode,exist_ok=True)
+            if owner is not None:
+                chown(dir, owner[0], owner[1])
+            if task_owner is not None:
+                for e in taskfiles:
+                    chown(os.path.join(dir,e), task_owner[0], task_owner[1])
+            if task_perm is not None:
+                for e in taskfiles:
+                    os.chmod(os.path.join(dir,e), task_perm)
+        return self
+
+    # brings the group to the given state touching only what differs (cgconfigparser): directories are made if missing,
+    # ownership and modes changed if not as given (None, or a None uid/gid, leaves them as they are) and values applied
+    # by update(). owner and task_owner must be numeric. returns (whether created, written keys, [(key or None, errno)]).
+    def converge(self, values=(), owner=None, task_owner=None, dperm=None, fperm=None):
+        taskfiles = ['tasks', 'cgroup.procs'] if self.tree.version == 1 else ['cgroup.procs']
+        created, failures = False, []
+        for typ, dir in self.dirs():
+            try:
+                if not os.path.isdir(dir):
+                    os.mkdir(dir, 0o755 if dperm is None else dperm)
+                    created = True
+                if owner is None and dperm is None and task_owner is None and fperm is None:
+                    continue
+                for path, own, perm in [(dir, owner, dperm)]+[(os.path.join(dir,e), task_owner, fperm) for e in taskfiles]:
+                    st = os.stat(path)
+                    if own is not None and any(id is not None and id != cur for id, cur in zip(own, (st.st_uid, st.st_gid))):
+                        chown(path, own[0], own[1])
+                    if perm is not None and st.st_mode&0o777 != perm:
+                        os.chmod(path, perm)
+            except (IOError, OSError) as e:
+                failures.append((None, e.errno))
+        if failures:
+            return created, [], failures
+        written, skipped, failed = self.update(values)
+        return created, written, failures+failed
+
+    def delete(self, recursive=False):
+        if recursive:
+            removed, failures = RemoveTree([dir for typ, dir in self.dirs()])
+            for path, err in failures:
+                raise OSError(err, os.strerror(err), path)
+            return
+        for typ, dir in self.dirs():
+            if os.path.isdir(dir):
+                os.rmdir(dir)
+
+    # removes the group and its descendants (cgdelete -r). members is None to leave populated groups failing with EBUSY,
+    # 'kill' to kill() or 'drain' to drain() their processes first.
+    # returns {'removed': number of directories, 'failed': [(directory, errno)], 'seconds': elapsed time}.
+    def teardown(self, jobs=1, members=None, retries=5):
+        import time
+        start = time.time()
+        if members == 'kill':
+            self.kill()
+        elif members == 'drain':
+            self.drain()
+        removed, failures = RemoveTree([dir for typ, dir in self.dirs()], jobs, retries)
+        return {'removed': removed, 'failed': failures, 'seconds': time.time()-start}
+
+    # kills the processes of the group and its descendants. v2 uses cgroup.kill (5.14+) if available. otherwise the group
+    # is frozen (cgroup.freeze or the v1 freezer hierarchy) so that nothing can fork while SIGKILL is sent, then thawed
+    # so that the processes can exit, until the subtree is empty. returns whether it became empty within timeout.
+    # if this process is inside the group, neither cgroup.kill nor the freezer is used and the others are sent SIGKILL.
+    def kill(self, timeout=5.0):
+        import signal
+        import time
+        dirs = [dir for typ, dir in self.dirs() if os.path.isdir(dir)]
+        inside = self.holds_caller()
+        if not inside and self.tree.version == 2 and dirs and os.path.isfile(os.path.join(dirs[0],'cgroup.kill')):
+            with open(os.path.join(dirs[0],'cgroup.kill'), 'w') as f:
+                f.write('1\n')
+        freezer = None if inside else self.freezer()
+        deadline = time.time()+timeout
+        while True:
+            pids = SubtreeProcs(dirs)
+            pids.discard(os.getpid())
+            if not pids:
+                return True
+            if time.time() > deadline:
+                return False
+            if freezer is not None:
+                with open(freezer[0], 'w') as f:
+                    f.write(freezer[1])
+            try:
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError as e:
+                        if e.errno != errno.ESRCH:
+                            raise
+            finally:
+                if freezer is not None:
+                    with open(freezer[0], 'w') as f:
+                        f.write(freezer[2])
+            time.sleep(0.01)
+
+    # whether this process is in the group or a descendant, in the hierarchy of its freezer (v2: the unified hierarchy),
+    # so that freezing or killing the group would stop the caller too.
+    def holds_caller(self):
+        own = ParseProcCgroup(ReadControlFile('/proc/self/cgroup')).get('' if self.tree.version == 2 else 'freezer')
+        return own is not None and self.contains(own)
+
+    # (file, frozen value, thawed value) of the freezer of the group: cgroup.freeze in v2, freezer.state of the v1 freezer
+    # hierarchy (whether or not the group is in controllers). None if there is none.
+    def freezer(self):
+        if self.tree.version == 2:
+            dir = os.path.join(self.tree.root,self.rel)
+            if os.path.isfile(os.path.join(dir,'cgroup.freeze')):
+                return (os.path.join(dir,'cgroup.freeze'), '1', '0')
+        elif os.path.isfile(os.path.join(self.tree.root,'freezer',self.rel,'freezer.state')):
+            return (os.path.join(self.tree.root,'freezer',self.rel,'freezer.state'), 'FROZEN', 'THAWED')
+        return None
+
+    # freezes (or thaws) the group and waits up to timeout for all of its processes to stop (cgroup.events in v2,
+    # freezer.state leaving FREEZING in v1). returns whether the group reached the state; False if it has no freezer.
+    def freeze(self, frozen=True, timeout=1.0):
+        import time
+        freezer = self.freezer()
+        if freezer is None:
+            return False
+        with open(freezer[0], 'w') as f:
+            f.write(freezer[1] if frozen else freezer[2])
+        if not frozen:
+            return True
+        deadline = time.time()+timeout
+        while True:
+            if self.tree.version == 2:
+                state = ReadKeyed(os.path.join(os.path.dirname(freezer[0]),'cgroup.events')).get('frozen') == 1
+            else:
+                state = ReadControlFile(freezer[0]).strip() == 'FROZEN'
+            if state or time.time() > deadline:
+                return state
+            time.sleep(0.001)
+
+    # moves the processes of the group (with recursive, also those of its descendants) to the group at path. the group
+    # is frozen meanwhile so that nothing forks behind the migration (unless this process is inside), migrated until it
+    # is empty, then thawed if it was not frozen before; in v1 the freezer hierarchy is migrated last.
+    # returns {'moved': number of moved pids (per hierarchy in v1), 'failed': [(pid, errno)], 'frozen': whether the
+    # group was frozen, 'seconds': elapsed time}. raises ValueError if path is the group (or with recursive, in its subtree).
+    def move(self, path, recursive=False, freeze=True, timeout=1.0):
+        import time
+        start = time.time()
+        # the processes would be moved again and again without ever leaving the source
+        if path.strip('/') == self.rel or recursive and self.contains(path):
+            raise ValueError('%s is in the source group %s'%(path, self.path))
+        target = self.tree.group(path, self.controllers)
+        pairs = [(typ, dir, tdir) for (typ, dir), (ttyp, tdir) in zip(self.dirs(), target.dirs()) if os.path.isdir(dir)]
+        pairs.sort(key=lambda e: e[0] == 'freezer')
+        freezer = self.freezer() if freeze else None
+        if freezer is not None:
+            if self.holds_caller() or ReadControlFile(freezer[0]).strip() != freezer[2]:
+                # freezing would stop this process, or it is already frozen (and stays so)
+                freezer = None
+        report = {'moved': 0, 'failed': [], 'frozen': False, 'seconds': 0}
+        try:
+            if freezer is not None:
+                report['frozen'] = self.freeze(True, timeout)
+            for typ, dir, tdir in pairs:
+                moved, failed = MigrateProcs([dir]+list(WalkCgroup(dir, dir)) if recursive else [dir], tdir)
+                report['moved'] += moved
+                report['failed'].extend(failed)
+        finally:
+            if freezer is not None:
+                self.freeze(False)
+        report['seconds'] = time.time()-start
+        return report
+
+    # moves the processes of the group and its descendants to the group at path (the root group by default),
+    # repeating while some get moved as they may be forking. returns [(pid, errno)] which could not be moved.
+    # raises ValueError if path is in the subtree (e.g. draining the root group).
+    def drain(self, path='/'):
+        if self.contains(path):
+            raise ValueError('%s is in the drained group %s'%(path, self.path))
+        target = self.tree.group(path, self.controllers)
+        failures = []
+        for (typ, dir), (ttyp, tdir) in zip(self.dirs(), target.dirs()):
+            if os.path.isdir(dir):
+                failures.extend(MigrateProcs([dir]+list(WalkCgroup(dir, dir)), tdir)[1])
+        return failures
+
+    # whether the group at path is this group or one of its descendants.
+    def contains(self, path):
+        rel = path.strip('/')
+        return not self.rel or rel == self.rel or rel.startswith(self.rel+'/')
+
+    # raw content of the control file; v1 names are converted in v2 where possible.
+    def read(self, key):
+        if self.tree.version == 2:
+            val = Cgroup2Read(self.dir(key), key)
+            if val is not None:
+                return '%s\n'%val
+        with open(os.path.join(self.dir(key),key), 'r') as f:
+            return f.read()
+
+    # value of a single valued control file, as int if numeric ('max' and the like are returned as str).
+    def get(self, key):
+        return ConvertToInt(self.read(key).strip())
+
+    # content of a keyed control file (e.g. memory.stat) as dict.
+    def stat(self, key):
+        return ReadKeyed(os.path.join(self.dir(key),key))
+
+    def set(self, key, val, force=False):
+        written, skipped, failures = self.update([(key, val)], force)
+        for key, err in failures:
+            raise OSError(err, os.strerror(err), key)
+
+    # applies [(key, value), ...] reading and writing each underlying file at most once.
+    # writes which would not change the current value are skipped unless force.
+    # returns (written keys, skipped keys, [(key, errno)]).
+    def update(self, values, force=False):
+        import collections
+        files = collections.OrderedDict()
+        for key, val in values:
+            val = str(val)
+            dir = self.dir(key)
+            if self.tree.version == 2 and key in cgroup2Table and cgroup2Table[key][2] is not None:
+                entry = cgroup2Table[key]
+                if os.path.isfile(os.path.join(dir,entry[0][0])):
+                    files.setdefault((dir, entry[0][0]), []).append((key, val, entry))
+                    continue
+            files.setdefault((dir, key), []).append((key, val, None))
+        # files other entries depend on (memory.max for memory.memsw.*) are computed first, so that their new content is used
+        order = sorted(files.items(), key=lambda e: any(entry is not None and len(entry[0]) > 1 for key, val, entry in e[1]))
+        cache = {}
+        written, skipped, failures = [], [], []
+        for (dir, file), ops in order:
+            path = os.path.join(dir,file)
+            keys = [key for key, val, entry in ops]
+            cur = None
+            if not force or any(entry is not None for key, val, entry in ops):
+                try:
+                    cur = ReadControlFile(path)
+                except (IOError, OSError) as e:
+                    # write-only files
+                    if e.errno not in [errno.EACCES, errno.EINVAL, errno.EPERM]:
+                        failures.extend((key, e.errno) for key in keys)
+                        continue
+            new = cur or ''
+            try:
+                for key, val, entry in ops:
+                    if entry is None:
+                        new = val
+                        continue
+                    conts = [new]+[ReadCached(cache, dir, e) for e in entry[0][1:]]
+                    if None in conts:
+                        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT))
+                    new = entry[2](conts, val)
+            except (IndexError, ValueError):
+                failures.extend((key, errno.EINVAL) for key in keys)
+                continue
+            except (IOError, OSError) as e:
+                failures.extend((key, e.errno) for key in keys)
+                continue
+            if not force and cur is not None and SameValue(file, cur, new):
+                cache[file] = cur
+                skipped.extend(keys)
+                continue
+            try:
+                # keyed files like io.max take one line per write(2)
+                fd = os.open(path, os.O_WRONLY|os.O_TRUNC)
+                try:
+                    for line in new.splitlines() or ['']:
+                        os.write(fd, ('%s\n'%line).encode('utf-8'))
+                finally:
+                    os.close(fd)
+            except (IOError, OSError) as e:
+                failures.extend((key, e.errno) for key in keys)
+                continue
+            cache[file] = new
+            written.extend(keys)
+        return written, skipped, failures
+
+    # yields (name, content) of the control files as cgget prints them; content is None if the file is not readable.
+    # in v2, v1 names in variables are converted and yielded first.
+    def values(self, variables=None):
+        for typ, dir in self.dirs():
+            if not os.path.isdir(dir):
+                continue
+            if self.tree.version == 2:
+                cache = {}
+                for key in variables or []:
+                    val = Cgroup2Read(dir, key, cache)
+                    if val is not None:
+                        yield key, '%s\n'%val
+            for name in self.tree.files(dir):
+                if self.tree.version == 1 and name in ['tasks', 'notify_on_release', 'release_agent']:
+                    continue
+                if self.tree.version == 2 and self.controllers and not name.startswith(tuple(e+'.' for e in self.controllers)):
+                    continue
+                if name.startswith('cgroup.'):
+                    continue
+                if variables and name not in variables:
+                    continue
+                # opening a write only control file fails with EACCES, so its mode need not be stat()ed
+                try:
+                    cont = ReadControlFile(os.path.join(dir,name))
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EACCES, errno.EPERM):
+                        raise
+                    cont = None
+                yield name, cont
+
+    # readable and writable control values of the group (and with recursive, of its descendants) as
+    # [(relative path, [(name, content), ...]), ...], parents before children. relative path is '' for the group itself.
+    def template(self, recursive=False):
+        rels = ['']
+        if recursive:
+            seen = set([''])
+            for grp in self.walk():
+                rel = grp.path[len(self.path.rstrip('/')):]
+                if rel not in seen:
+                    seen.add(rel)
+                    rels.append(rel)
+            rels.sort(key=lambda e: e.count('/'))
+        return [(rel, Cgroup(self.tree, self.path.rstrip('/')+rel, self.controllers).settings()) for rel in rels]
+
+    # [(name, content), ...] of the control files of the group which are readable and writable (i.e. can be restored),
+    # excluding cgroup.* and unsettableFiles.
+    def settings(self):
+        values = []
+        for typ, dir in self.dirs():
+            if not os.path.isdir(dir):
+                continue
+            for ent in sorted(scandir(dir), key=lambda e: e.name):
+                if ent.name in unsettableFiles or ent.name.startswith('cgroup.') or ent.name.endswith(unsettableSuffixes):
+                    continue
+                if not ent.is_file() or ent.stat().st_mode&0o600 != 0o600:
+                    continue
+                try:
+                    values.append((ent.name, ReadControlFile(ent.path)))
+                except (IOError, OSError):
+                    continue
+        return values
+
+    # settings() with the ownership of the group for cgsnapshot: {'path', 'controllers', 'values', 'owner': (uid, gid) and 'dperm' of the
+    # directory, 'task_owner' and 'fperm' of the tasks file}. in v1 they are taken from the first hierarchy of the group.
+    def snapshot(self):
+        dir = [dir for typ, dir in self.dirs() if os.path.isdir(dir)][0]
+        st = os.stat(dir)
+        tst = os.stat(os.path.join(dir,'tasks' if self.tree.version == 1 else 'cgroup.procs'))
+        return {'path': self.path, 'controllers': self.controllers, 'values': self.settings(), 'owner': (st.st_uid, st.st_gid), 'dperm': st.st_mode&0o777, 'task_owner': (tst.st_uid, tst.st_gid), 'fperm': tst.st_mode&0o777}
+
+    # mirrors a template() onto this group, creating its descendants when missing (and with create, the group itself).
+    # values equal to the current ones are not written unless force.
+    # returns {'written': [(path, key)], 'skipped': [(path, key)], 'failed': [(path, key, errno)]}.
+    def apply_template(self, template, force=False, create=False):
+        report = {'written': [], 'skipped': [], 'failed': []}
+        for rel, values in template:
+            grp = Cgroup(self.tree, self.path.rstrip('/')+rel, self.controllers)
+            if (rel or create) and not all(os.path.isdir(dir) for typ, dir in grp.dirs()):
+                try:
+                    grp.create()
+                except (IOError, OSError) as e:
+                    report['failed'].extend((grp.path, key, e.errno) for key, val in values)
+                    continue
+            written, skipped, failures = grp.update(values, force)
+            report['written'].extend((grp.path, key) for key in written)
+            report['skipped'].extend((grp.path, key) for key in skipped)
+            report['failed'].extend((grp.path, key, err) for key, err in failures)
+        return report
+
+    # copies the parameters of src (cgset --copy-from), with recursive its whole subtree (creating the missing groups).
+    # see apply_template().
+    def copy_from(self, src, recursive=False, force=False):
+        return self.apply_template(src.template(recursive), force, recursive)
+
+    # moves pids into the group; returns a list of (pid, errno) which could not be moved.
+    def classify(self, pids):
+        failures = []
+        for typ, dir in self.dirs():
+            fd = os.open(os.path.join(dir,'cgroup.procs'), os.O_WRONLY|os.O_APPEND)
+            try:
+                failures.extend(ClassifyPids(fd, pids))
+            finally:
+                os.close(fd)
+        return failures
+
+    def procs(self):
+        for typ, dir in self.dirs():
+            if os.path.isfile(os.path.join(dir,'cgroup.procs')):
+                with open(os.path.join(dir,'cgroup.procs')) as f:
+                    return [int(e) for e in f.read().split()]
+        return []
+
+    # pids in the group (and with recursive, in its descendants); in v1 the union of its hierarchies.
+    def members(self, recursive=True):
+        dirs = [dir for typ, dir in self.dirs() if os.path.isdir(dir)]
+        return sorted(SubtreeProcs(dirs) if recursive else ReadProcs(dirs))
+
+    # starts cmd as a child process in the group and returns its pid. in v2 the child is created inside the group
+    # by clone3(CLONE_INTO_CGROUP) if possible; otherwise it is forked and moves itself before exec.
+    def spawn(self, cmd):
+        if self.tree.version == 2:
+            dirfd = os.open(self.dirs()[0][1], os.O_RDONLY|os.O_DIRECTORY)
+            try:
+                pid = CloneIntoCgroup(dirfd)
+            finally:
+                os.close(dirfd)
+            if pid == 0:
+                ExecChild(cmd)
+            if pid is not None:
+                return pid
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for failed, err in self.classify([os.getpid()]):
+                    sys.stderr.write('failed to move pid %d to %s: %s\n'%(failed, self.path, os.strerror(err)))
+                    os._exit(127)
+            except BaseException as e:
+                sys.stderr.write('%s\n'%e)
+                os._exit(127)
+            ExecChild(cmd)
+        return pid
+
+    # final accounting of the group: {'cpu.stat': {key: value}, 'memory.peak': bytes} (v1: memory.max_usage_in_bytes,
+    # and cpuacct.usage in nanoseconds), each present only if the file is.
+    def accounting(self):
+        result = {}
+        for key, file in [('cpu.stat', 'cpu.stat'), ('memory.peak', 'memory.peak' if self.tree.version == 2 else 'memory.max_usage_in_bytes'), ('cpuacct.usage', 'cpuacct.usage')]:
+            if self.tree.version == 1 and self.controllers is not None and file.split('.')[0] not in self.controllers:
+                continue
+            path = os.path.join(self.dir(file),file)
+            try:
+                if key == 'cpu.stat':
+                    result[key] = ReadKeyed(path)
+                else:
+                    result[key] = int(ReadControlFile(path))
+            except (IOError, OSError, ValueError):
+                continue
+        return result
+
+    # runs jobs ([(cmd, [(name, value), ...])]) each in a transient child group, at most concurrency of them at once.
+    # a child group is created with template (values applied to every job first) and the values of its job, the command
+    # is started by spawn(), and once it exits its accounting() is taken and the group removed (killing what the job
+    # left behind) unless keep. yields {'job': index, 'cmd', 'group', 'pid', 'status', 'seconds', 'accounting',
+    # 'error': (key or None, errno) of a failed creation} in the order the jobs finish.
+    def run_jobs(self, jobs, concurrency=1, template=(), keep=False):
+        import time
+        def remove(grp):
+            for typ, dir in grp.dirs():
+                if RemoveDir(dir) == errno.EBUSY:
+                    grp.kill()
+                    RemoveDir(dir)
+        jobs = iter(enumerate(jobs))
+        running = {}
+        pidfds = {}
+        prepared = False
+        try:
+            while True:
+                while len(running) < concurrency:
+                    try:
+                        index, (cmd, values) = next(jobs)
+                    except StopIteration:
+                        break
+                    grp = self.child('job-%d-%d'%(os.getpid(), index))
+                    values = list(template)+list(values)
+                    result = {'job': index, 'cmd': cmd, 'group': grp.path, 'pid': None, 'status': None, 'seconds': 0.0, 'accounting': {}}
+                    try:
+                        if not prepared:
+                            # ancestors and v2 subtree_control of the parent are the same for every job
+                            for path, key, err in self.tree.prepare([(grp, values)]):
+                                raise OSError(err, os.strerror(err), path)
+                            prepared = True
+                        grp.create()
+                        written, skipped, failures = grp.update(values, True)
+                        if failures:
+                            raise OSError(failures[0][1], os.strerror(failures[0][1]), failures[0][0])
+                    except (IOError, OSError) as e:
+                        result['error'] = (getattr(e, 'filename', None), e.errno)
+                        remove(grp)
+                        yield result
+                        continue
+                    result['start'] = time.time()
+                    result['pid'] = grp.spawn(cmd)
+                    running[result['pid']] = (grp, result)
+                    if hasattr(os, 'pidfd_open'):
+                        try:
+                            pidfds[result['pid']] = os.pidfd_open(result['pid'])
+                        except OSError:
+                            pass
+                if not running:
+                    return
+                # only the jobs are waited for (os.wait() would reap the other children of a library caller): a pidfd
+                # becomes readable when its process exits; without pidfds (Python < 3.9, Linux < 5.3) they are polled.
+                pid, status = WaitAnyChild(running, pidfds)
+                if pid == 0:
+                    continue
+                if pid in pidfds:
+                    os.close(pidfds.pop(pid))
+                grp, result = running.pop(pid)
+                result['status'] = 128+os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                result['seconds'] = time.time()-result.pop('start')
+                result['accounting'] = grp.accounting()
+                if not keep:
+                    remove(grp)
+                yield result
+        finally:
+            # interrupted: the jobs still running are killed and their groups removed
+            for grp, result in running.values():
+                grp.kill()
+                if not keep:
+                    remove(grp)
+            for fd in pidfds.values():
+                os.close(fd)
+
+    def walk(self, depth=None, patterns=None, jobs=1):
+        return self.tree.walk(self.path, self.controllers, depth, patterns, jobs)
+
+def GetCgroupTree():
+    global cgrtree
+    if cgrtree is None:
+        cgrtree = CgroupTree(*GetCgroupMount())
+        # $CIELCG_INDEX_CACHE names a file keeping the hierarchy indexes across invocations (see CgroupTree.use_index())
+        if os.environ.get('CIELCG_INDEX_CACHE'):
+            cgrtree.use_index(os.environ['CIELCG_INDEX_CACHE'], float(os.environ.get('CIELCG_INDEX_TTL', '0')))
+    return cgrtree
+
+# '<controllers>:<path>' -> Cgroup
+def ParseGroup(tree, grp):
+    typ, path = grp.split(':',1)
+    return tree.group(path, [typ] if typ.strip('/') else None)
+
+# v1 hierarchy directories (tree.controllers) named by a comma separated controller list. a name may be a mount point
+# itself ("cpu,cpuacct") or a symlink to one ("cpu"); names mounted nowhere are dropped.
+def ResolveHierarchies(tree, typ):
+    typs = []
+    for name in ([typ] if os.path.isdir(os.path.join(tree.root,typ)) else typ.split(',')):
+        dir = os.path.join(tree.root,name)
+        if os.path.isdir(dir):
+            name = os.path.basename(os.path.realpath(dir))
+            if name in tree.controllers and name not in typs:
+                typs.append(name)
+    return typs
+
+# argparse.Namespace substitute for the argv parsed without argparse.
+class ParsedArgs(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+# parses the common '-g <controllers>:<path> ... [--] args...' form by hand, as importing and building argparse
+# dominates the run time of cgexec/cgclassify. returns (groups, args), or None if argv has any other option
+# so that the caller falls back to argparse. options in flags are returned among groups as is.
+def ParseGroupArgv(argv, flags=()):
+    groups = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in flags:
+            groups.append(arg)
+            i += 1
+        elif arg == '-g' and i+1 < len(argv):
+            groups.append(argv[i+1])
+            i += 2
+        elif arg.startswith('-g') and len(arg) > 2:
+            groups.append(arg[2:])
+            i += 1
+        elif arg == '--':
+            return groups, argv[i+1:]
+        elif arg.startswith('-'):
+            return None
+        else:
+            return groups, argv[i:]
+    return groups, []
 
 def cgexec(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
-    parser = argparse.ArgumentParser(prog='cgexec')
-    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group which should be added')
-    parser.add_argument('cmd', nargs=argparse.REMAINDER, help='Command to execute')
-    args = parser.parse_args(argv)
+    tree = GetCgroupTree()
+    parsed = ParseGroupArgv(argv, ['--clone'])
+    if parsed is not None:
+        args = ParsedArgs(g=[e for e in parsed[0] if e != '--clone'], clone='--clone' in parsed[0], cmd=parsed[1], batch=None)
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(prog='cgexec')
+        parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group which should be added')
+        parser.add_argument('--clone', action='store_true', help='On v2, start the command as a child created inside the group by clone3(CLONE_INTO_CGROUP) and wait for it (falls back to moving itself and exec)')
+        parser.add_argument('--batch', metavar='<file>', help='Run the jobs of the file (lines of "[<name>=<value> ...] [--] command", - for stdin) each in a transient child group of the -g groups')
+        parser.add_argument('-j', '--jobs', type=int, help='Number of batch jobs to run at once (default: number of CPUs)')
+        parser.add_argument('-t', '--template', metavar='<path>', help='Group whose settings are applied to every batch job group')
+        parser.add_argument('-r', '--variable', metavar='<name=value>', action='append', default=[], help='Parameter of every batch job group')
+        parser.add_argument('--keep', action='store_true', help='Do not remove the batch job groups')
+        parser.add_argument('--json', action='store_true', help='Report the batch jobs as JSON objects, one per line')
+        parser.add_argument('cmd', nargs=argparse.REMAINDER, help='Command to execute')
+        args = parser.parse_args(argv)
+        if args.cmd[:1] == ['--']:
+            args.cmd = args.cmd[1:]
+        if args.batch is not None:
+            return CgexecBatch(logout, tree, parser, args)
     # print(args.cmd)
 
     if not args.cmd:
         sys.stderr.write('command to execute is not specified\n')
         return
 
+    if args.clone and tree.version == 2 and args.g:
+        # in v2 a process belongs to a single group, so the last one is what migration would end up with
+        dirfd = os.open(ParseGroup(tree, args.g[-1]).dirs()[0][1], os.O_RDONLY|os.O_DIRECTORY)
+        try:
+            pid = CloneIntoCgroup(dirfd)
+        finally:
+            os.close(dirfd)
+        if pid == 0:
+            ExecChild(args.cmd)
+        if pid is not None:
+            import signal
+            # the terminal delivers SIGINT/SIGQUIT to the child as well; others are forwarded
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+            for signum in [signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2]:
+                signal.signal(signum, lambda signum, frame: os.kill(pid, signum))
+            return WaitChild(pid)
+
     pid = os.getpid()
-    if cgrver == 1:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            with open(os.path.join(cgrpath,typ,path,'cgroup.procs'), 'a') as f:
-                f.write('%d\n'%pid)
-    elif cgrver == 2:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            with open(os.path.join(cgrpath,path,'cgroup.procs'), 'a') as f:
-                f.write('%d\n'%pid)
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    for grp in args.g:
+        for failed, err in ParseGroup(tree, grp).classify([pid]):
+            raise OSError(err, os.strerror(err), grp)
     os.execvp(args.cmd[0],args.cmd)
 
-def cgset(logout, argv):
-    def cgr2write(dir, key, val):
-        if key == 'cpu.cfs_period_us':
-            if os.path.isfile(os.path.join(dir,'cpu.max')):
-                with open(os.path.join(dir,'cpu.max'), 'r+') as f:
-                    cont = f.read().split()
-                    cont[1] = val
-                    f.seek(0)
-                    f.write('%s\n'%(' '.join(cont)))
-                    f.truncate(f.tell())
-                return True
-            return False
-        if key == 'cpu.cfs_quota_us':
-            if os.path.isfile(os.path.join(dir,'cpu.max')):
-                with open(os.path.join(dir,'cpu.max'), 'r+') as f:
-                    cont = f.read().split()
-                    cont[0] = 'max' if val=='-1' else val
-                    f.seek(0)
-                    f.write('%s\n'%(' '.join(cont)))
-                    f.truncate(f.tell())
-                return True
-            return False
-        if key == 'cpu.rt_period_us':
-            if os.path.isfile(os.path.join(dir,'cpu.rt.max')):
-                with open(os.path.join(dir,'cpu.rt.max'), 'r+') as f:
-                    cont = f.read().split()
-                    cont[1] = val
-                    f.seek(0)
-                    f.write('%s\n'%(' '.join(cont)))
-                    f.truncate(f.tell())
-                return True
-            return False
-        if key == 'cpu.rt_runtime_us':
-            if os.path.isfile(os.path.join(dir,'cpu.rt.max')):
-                with open(os.path.join(dir,'cpu.rt.max'), 'r+') as f:
-                    cont = f.read().split()
-                    cont[0] = 'max' if val=='-1' else val
-                    f.seek(0)
-                    f.write('%s\n'%(' '.join(cont)))
-                    f.truncate(f.tell())
-                return True
-            return False
-        elif key == 'cpu.shares':
-            if os.path.isfile(os.path.join(dir,'cpu.weight')):
-                with open(os.path.join(dir,'cpu.weight'), 'w') as f:
-                    f.write('%d\n'%(int(val) * 100 // 1024))
-                return True
-            return False
-        elif key == 'memory.limit_in_bytes':
-            if os.path.isfile(os.path.join(dir,'memory.max')):
-                with open(os.path.join(dir,'memory.max'), 'w') as f:
-                    f.write('%s\n'%val) # todo handle max properly
-                return True
-            return False
-        elif key == 'memory.soft_limit_in_bytes':
-            if os.path.isfile(os.path.join(dir,'memory.high')):
-                with open(os.path.join(dir,'memory.high'), 'w') as f:
-                    f.write('%s\n'%val) # todo handle max properly
-                return True
-            return False
+# yields (command, [(name, value), ...]) from lines of '[<name>=<value> ...] [--] command' split like the shell.
+# leading words of the form <controller>.<file>=<value> are values; '#' starts a comment.
+def ReadJobs(f):
+    import re
+    import shlex
+    for line in f:
+        words = shlex.split(line, comments=True)
+        values = []
+        while words and re.match(r'[a-z_]+\.[a-z0-9_.]+=', words[0]):
+            values.append(tuple(words.pop(0).split('=',1)))
+        if words[:1] == ['--']:
+            words.pop(0)
+        if words:
+            yield words, values
 
-    cgrpath, cgrver = GetCgroupMount()
+def CgexecBatch(logout, tree, parser, args):
+    if not args.g:
+        parser.error('--batch requires -g')
+    grps = [ParseGroup(tree, grp) for grp in args.g]
+    if len(set(grp.path for grp in grps)) > 1:
+        parser.error('-g groups of --batch must have the same path')
+    # one group over the hierarchies of all -g (v1), as spawn() puts the job in all of them
+    parent = tree.group(grps[0].path, None if any(grp.controllers is None for grp in grps) else [typ for grp in grps for typ in grp.controllers])
+    variables = []
+    for var in args.variable:
+        if '=' not in var:
+            parser.error('invalid variable "%s"'%var)
+        variables.append(tuple(var.split('=',1)))
+    template = (tree.group(args.template, parent.controllers).settings() if args.template is not None else [])+variables
+    concurrency = args.jobs
+    if concurrency is None:
+        import multiprocessing
+        concurrency = multiprocessing.cpu_count()
+    if args.json:
+        import json
+    f = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+    ret = 0
+    try:
+        for result in parent.run_jobs(ReadJobs(f), concurrency, template, args.keep):
+            if 'error' in result:
+                key, err = result['error']
+                sys.stderr.write('failed to create %s%s: %s\n'%(result['group'], '' if key is None else ' (%s)'%key, os.strerror(err)))
+                ret = 1
+                continue
+            if result['status'] != 0:
+                ret = 1
+            if args.json:
+                logout.write('%s\n'%json.dumps(result, sort_keys=True))
+                continue
+            acct = result['accounting']
+            cpu = acct.get('cpu.stat', {}).get('usage_usec')
+            if cpu is None and 'cpuacct.usage' in acct:
+                cpu = acct['cpuacct.usage']//1000
+            logout.write('%d %d %.3fs cpu=%sus peak=%s %s\n'%(result['job'], result['status'], result['seconds'], '-' if cpu is None else cpu, acct.get('memory.peak', '-'), ' '.join(result['cmd'])))
+            logout.flush()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return ret
+
+# yields (path, [(name, value), ...]) from lines of '<path> <name>=<value> ...'; '#' starts a comment.
+def ReadSetSpec(f):
+    for line in f:
+        cols = line.split('#',1)[0].split()
+        if not cols:
+            continue
+        values = []
+        for var in cols[1:]:
+            if '=' not in var:
+                raise ValueError('invalid variable "%s" for %s'%(var, cols[0]))
+            values.append(tuple(var.split('=',1)))
+        yield cols[0], values
+
+# expands braces like the shell: 'slot{1..3}' -> ['slot1', 'slot2', 'slot3'], 'a{b,c}d' -> ['abd', 'acd'].
+# ranges may have a step ('{0..10..5}') and keep zero padding ('{01..10}'); braces without ',' or '..' are literal.
+def ExpandBraces(pattern):
+    import re
+    depth = 0
+    for i, c in enumerate(pattern):
+        if c == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        return [pattern]
+    prefix, body, suffix = pattern[:start], pattern[start+1:i], pattern[i+1:]
+    m = re.match(r'^(-?\d+)\.\.(-?\d+)(?:\.\.(\d+))?$', body)
+    if m:
+        first, last, step = int(m.group(1)), int(m.group(2)), int(m.group(3) or 1) or 1
+        width = max(len(m.group(1)), len(m.group(2))) if any(re.match(r'^-?0\d', e) for e in m.group(1, 2)) else 0
+        alts = ['%0*d'%(width, e) for e in range(first, last+(1 if first <= last else -1), step if first <= last else -step)]
+    else:
+        alts, depth, begin = [], 0, 0
+        for j, c in enumerate(body):
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+            elif c == ',' and depth == 0:
+                alts.append(body[begin:j])
+                begin = j+1
+        alts.append(body[begin:])
+        if len(alts) == 1:
+            return [prefix+'{'+e+'}'+rest for e in ExpandBraces(body) for rest in ExpandBraces(suffix)]
+        alts = [e for alt in alts for e in ExpandBraces(alt)]
+    return [prefix+alt+rest for alt in alts for rest in ExpandBraces(suffix)]
+
+def cgset(logout, argv):
+    import argparse
+    import collections
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='cgset')
     parser.add_argument('-r', '--variable', metavar='<name=value>', action='append', default=[], help='Define parameter to set')
     parser.add_argument('--copy-from', metavar='<source_cgroup_path>', help='Control group whose parameters will be copied')
-    parser.add_argument('path', nargs='+', help='Control group')
+    parser.add_argument('-f', '--file', metavar='<spec>', help='Apply lines of "<path> <name>=<value> ..." from the file (- for stdin)')
+    parser.add_argument('-R', '--recursive', action='store_true', help='With --copy-from, mirror the whole subtree of the source (missing groups are created)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of target groups to copy into concurrently')
+    parser.add_argument('--force', action='store_true', help='Write values even if they are unchanged')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print written and skipped variables')
+    parser.add_argument('path', nargs='*', help='Control group')
     args = parser.parse_args(argv)
 
-    if args.copy_from is None and not args.variable:
+    if args.copy_from is None and not args.variable and args.file is None:
         sys.stderr.write('need to parameter value or source\n')
         return
+    if args.file is None and not args.path:
+        parser.error('the following arguments are required: path')
 
-    if cgrver == 1:
-        for path in args.path:
-            if path.startswith('/'):
-                path = path[1:]
-            if args.copy_from is not None:
-                src = args.copy_from
-                if src.startswith('/'):
-                    src = src[1:]
-                for typ in [e for e in os.listdir(cgrpath) if not os.path.islink(os.path.join(cgrpath,e))]:
-                    if os.path.isdir(os.path.join(cgrpath,typ,src)) and os.path.isdir(os.path.join(cgrpath,typ,path)):
-                        for ent in os.listdir(os.path.join(cgrpath,typ,src)):
-                            if os.path.isfile(os.path.join(cgrpath,typ,src,ent)):
-                                if ent in ['tasks', 'notify_on_release', 'release_agent']:
-                                    continue
-                                if ent.startswith('cgroup.'):
-                                    continue
-                                with open(os.path.join(cgrpath,typ,src,ent), 'r') as fin:
-                                    try:
-                                        with open(os.path.join(cgrpath,typ,path,ent), 'w') as fout:
-                                            shutil.copyfileobj(fin, fout)
-                                    except OSError as e:
-                                        if e.errno!=errno.EINVAL:
-                                            raise
-            for var in args.variable:
-                key, val = var.split('=',1)
-                typ = key.split('.')[0]
-                with open(os.path.join(cgrpath,typ,path,key), 'w') as f:
-                    f.write(val)
-    elif cgrver == 2:
-        for path in args.path:
-            if path.startswith('/'):
-                path = path[1:]
-            if args.copy_from is not None:
-                src = args.copy_from
-                if src.startswith('/'):
-                    src = src[1:]
-                for ent in os.listdir(os.path.join(cgrpath,src)):
-                    if os.path.isfile(os.path.join(cgrpath,src,ent)):
-                        if ent.startswith('cgroup.'):
-                            continue
-                        with open(os.path.join(cgrpath,src,ent), 'r') as fin:
-                            try:
-                                with open(os.path.join(cgrpath,path,ent), 'w') as fout:
-                                    shutil.copyfileobj(fin, fout)
-                            except OSError as e:
-                                if e.errno!=errno.EINVAL:
-                                    raise
-            for var in args.variable:
-                key, val = var.split('=',1)
-                if not cgr2write(os.path.join(cgrpath,path), key, val):
-                    with open(os.path.join(cgrpath,path,key), 'w') as f:
-                        f.write(val)
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    values = collections.OrderedDict()
+    for path in args.path:
+        values.setdefault(path, []).extend(tuple(var.split('=',1)) for var in args.variable)
+    if args.file is not None:
+        f = sys.stdin if args.file == '-' else open(args.file)
+        try:
+            for path, vals in ReadSetSpec(f):
+                values.setdefault(path, []).extend(vals)
+        finally:
+            if f is not sys.stdin:
+                f.close()
 
-def cgget(logout, argv):
-    def cgr2read(logout, args, dir, key):
-        if key == 'cpu.cfs_period_us':
-            if os.path.isfile(os.path.join(dir,'cpu.max')):
-                with open(os.path.join(dir,'cpu.max'), 'r') as f:
-                    cont = f.read().split()[1]
-                if not args.values_only:
-                    logout.write('cpu.cfs_period_us: ')
-                logout.write('%s\n'%cont)
-                return True
-            return False
-        elif key == 'cpu.cfs_quota_us':
-            if os.path.isfile(os.path.join(dir,'cpu.max')):
-                with open(os.path.join(dir,'cpu.max'), 'r') as f:
-                    cont = f.read().split()[0]
-                if not args.values_only:
-                    logout.write('cpu.cfs_quota_us: ')
-                logout.write('%s\n'%('-1' if cont == 'max' else cont))
-                return True
-            return False
-        elif key == 'cpu.rt_period_us':
-            if os.path.isfile(os.path.join(dir,'cpu.rt.max')):
-                with open(os.path.join(dir,'cpu.rt.max'), 'r') as f:
-                    cont = f.read().split()[1]
-                if not args.values_only:
-                    logout.write('cpu.rt_period_us: ')
-                logout.write('%s\n'%cont)
-                return True
-            return False
-        elif key == 'cpu.rt_runtime_us':
-            if os.path.isfile(os.path.join(dir,'cpu.rt.max')):
-                with open(os.path.join(dir,'cpu.rt.max'), 'r') as f:
-                    cont = f.read().split()[0]
-                if not args.values_only:
-                    logout.write('cpu.rt_runtime_us: ')
-                logout.write('%s\n'%('-1' if cont == 'max' else cont))
-                return True
-            return False
-        elif key == 'cpu.shares':
-            if os.path.isfile(os.path.join(dir,'cpu.weight')):
-                with open(os.path.join(dir,'cpu.weight'), 'r') as f:
-                    cont = int(f.read())
-                if not args.values_only:
-                    logout.write('cpu.shares: ')
-                logout.write('%d\n'%(1024 * cont // 100))
-                return True
-            return False
-        elif key == 'memory.limit_in_bytes':
-            if os.path.isfile(os.path.join(dir,'memory.max')):
-                with open(os.path.join(dir,'memory.max'), 'r') as f:
-                    cont = f.read().strip()
-                if not args.values_only:
-                    logout.write('memory.limit_in_bytes: ')
-                logout.write('%s\n'%(str((1<<63)-4096) if cont == 'max' else cont))
-                return True
-            return False
-        elif key == 'memory.soft_limit_in_bytes':
-            if os.path.isfile(os.path.join(dir,'memory.high')):
-                with open(os.path.join(dir,'memory.high'), 'r') as f:
-                    cont = f.read().strip()
-                if not args.values_only:
-                    logout.write('memory.soft_limit_in_bytes: ')
-                logout.write('%s\n'%(str((1<<63)-4096) if cont == 'max' else cont))
-                return True
-            return False
+    ret = 0
+    if args.copy_from is not None:
+        # the template is read once and applied to the targets on a thread pool
+        template = tree.group(args.copy_from).template(args.recursive)
+        targets = [tree.group(path) for path in args.path]
+        if not args.recursive:
+            # only -R creates missing groups
+            missing = [grp for grp in targets if not any(os.path.isdir(dir) for typ, dir in grp.dirs())]
+            for grp in missing:
+                sys.stderr.write('%s does not exist\n'%grp.path)
+                ret = 1
+            targets = [grp for grp in targets if grp not in missing]
+        for report in ParallelMap(lambda grp: grp.apply_template(template, args.force, args.recursive), targets, args.jobs):
+            if args.verbose:
+                for path, key in report['written']:
+                    logout.write('written %s %s\n'%(path, key))
+                for path, key in report['skipped']:
+                    logout.write('skipped %s %s\n'%(path, key))
+            for path, key, err in report['failed']:
+                sys.stderr.write('failed to copy %s of %s: %s\n'%(key, path, os.strerror(err)))
+                ret = 1
+    for path in values:
+        written, skipped, failures = tree.group(path).update(values[path], args.force)
+        if args.verbose:
+            for key in written:
+                logout.write('written %s %s\n'%(path, key))
+            for key in skipped:
+                logout.write('skipped %s %s\n'%(path, key))
+        for key, err in failures:
+            sys.stderr.write('failed to set %s of %s: %s\n'%(key, path, os.strerror(err)))
+            ret = 1
+    return ret
+
+# buffers small writes (such as cgget's lines) into chunks of size bytes.
+class BufferedOutput(object):
+    def __init__(self, out, size=1<<20):
+        self.out = out
+        self.size = size
+        self.chunks = []
+        self.length = 0
 
-    cgrpath, cgrver = GetCgroupMount()
+    def write(self, s):
+        self.chunks.append(s)
+        self.length += len(s)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.out.write(''.join(self.chunks))
+            self.chunks = []
+            self.length = 0
+
+def cgget(logout, argv):
+    import argparse
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='cgget')
     parser.add_argument('-g', action='append', default=[], metavar='<controllers>(:<path>)', help='Control group which should be added')
     parser.add_argument('-r', '--variable', metavar='<name>', action='append', default=[], help='Define parameter to display')
     parser.add_argument('-n', action='store_true', help='Do not print headers')
     parser.add_argument('-v', '--values-only', action='store_true', help='Print only values, not parameter names')
+    parser.add_argument('--stdin', action='store_true', help='Read groups (<path> or <controllers>:<path>) from stdin, one per line')
+    parser.add_argument('--glob', action='append', default=[], metavar='<pattern>', help='Add the groups whose path matches the pattern')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of groups to read concurrently')
+    parser.add_argument('--json', action='store_true', help='Print a JSON object ({"path", "controllers", "values"}) per group and line')
     parser.add_argument('path', nargs='*', help='Control group')
     args = parser.parse_args(argv)
 
-    paths = []
-    for path in args.path:
-        paths.append(path)
-    typs = []
-    for grp in args.g:
-        typpath = grp.split(':')
-        if len(typpath)==1:
-            typs.append(typpath[0])
-    if not typs and cgrver == 1:
-        typs = [e for e in os.listdir(cgrpath) if not os.path.islink(os.path.join(cgrpath,e))]
-
-    if cgrver == 1:
-        for path in args.path:
-            if not args.n:
-                logout.write('%s:\n'%path)
-            if path.startswith('/'):
-                path = path[1:]
-            for typ in typs:
-                if os.path.isdir(os.path.join(cgrpath,typ,path)):
-                    for ent in sorted(os.listdir(os.path.join(cgrpath,typ,path))):
-                        if not os.path.isfile(os.path.join(cgrpath,typ,path,ent)):
-                            continue
-                        if ent in ['tasks', 'notify_on_release', 'release_agent']:
-                            continue
-                        if ent.startswith('cgroup.'):
-                            continue
-                        if args.variable and ent not in args.variable:
-                            continue
-                        if not args.values_only:
-                            logout.write('%s: '%ent)
-                        if not os.stat(os.path.join(cgrpath,typ,path,ent)).st_mode&0o400:
-                            logout.write('\n')
-                            continue
-                        with open(os.path.join(cgrpath,typ,path,ent), 'r') as f:
-                            shutil.copyfileobj(f, logout)
-        for grp in args.g:
-            typpath = grp.split(':')
-            if len(typpath)==2:
-                typ, path = typpath
-                if not args.n:
-                    logout.write('%s:\n'%path)
-                if path.startswith('/'):
-                    path = path[1:]
-                if os.path.isdir(os.path.join(cgrpath,typ,path)):
-                    for ent in sorted(os.listdir(os.path.join(cgrpath,typ,path))):
-                        if not os.path.isfile(os.path.join(cgrpath,typ,path,ent)):
-                            continue
-                        if ent in ['tasks', 'notify_on_release', 'release_agent']:
-                            continue
-                        if ent.startswith('cgroup.'):
-                            continue
-                        if args.variable and ent not in args.variable:
-                            continue
-                        if not args.values_only:
-                            logout.write('%s: '%ent)
-                        if not os.stat(os.path.join(cgrpath,typ,path,ent)).st_mode&0o400:
-                            logout.write('\n')
-                            continue
-                        with open(os.path.join(cgrpath,typ,path,ent), 'r') as f:
-                            shutil.copyfileobj(f, logout)
-    elif cgrver == 2:
+    typs = [grp for grp in args.g if ':' not in grp]
+    def target(grp):
+        if ':' in grp:
+            return grp.split(':',1)[1], ParseGroup(tree, grp)
+        return grp, tree.group(grp, typs)
+    # targets are consumed lazily, so that groups are read while stdin or the tree is still being scanned
+    def targets():
         for path in args.path:
-            if not args.n:
-                logout.write('%s:\n'%path)
-            if path.startswith('/'):
-                path = path[1:]
-            if 1:
-                if os.path.isdir(os.path.join(cgrpath,path)):
-                    for ent in args.variable:
-                        cgr2read(logout, args, os.path.join(cgrpath,path), ent)
-                    for ent in sorted(os.listdir(os.path.join(cgrpath,path))):
-                        if not os.path.isfile(os.path.join(cgrpath,path,ent)):
-                            continue
-                        if ent.startswith('cgroup.'):
-                            continue
-                        if args.variable and ent not in args.variable:
-                            continue
-                        if not args.values_only:
-                            logout.write('%s: '%ent)
-                        if not os.stat(os.path.join(cgrpath,path,ent)).st_mode&0o400:
-                            logout.write('\n')
-                            continue
-                        with open(os.path.join(cgrpath,path,ent), 'r') as f:
-                            shutil.copyfileobj(f, logout)
+            yield path, tree.group(path, typs)
         for grp in args.g:
-            typpath = grp.split(':')
-            if len(typpath)==2:
-                typ, path = typpath
-                if not args.n:
-                    logout.write('%s:\n'%path)
-                if path.startswith('/'):
-                    path = path[1:]
-                if os.path.isdir(os.path.join(cgrpath,path)):
-                    for ent in args.variable:
-                        cgr2read(logout, args, os.path.join(cgrpath,path), ent)
-                    for ent in sorted(os.listdir(os.path.join(cgrpath,path))):
-                        if not os.path.isfile(os.path.join(cgrpath,path,ent)):
-                            continue
-                        if not ent.startswith(typ+'.'):
-                            continue
-                        if ent.startswith('cgroup.'):
-                            continue
-                        if args.variable and ent not in args.variable:
-                            continue
-                        if not args.values_only:
-                            logout.write('%s: '%ent)
-                        if not os.stat(os.path.join(cgrpath,path,ent)).st_mode&0o400:
-                            logout.write('\n')
-                            continue
-                        with open(os.path.join(cgrpath,path,ent), 'r') as f:
-                            shutil.copyfileobj(f, logout)
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+            if ':' in grp:
+                yield target(grp)
+        if args.glob:
+            if tree.version == 1:
+                for grp in tree.walk('/', typs or None, patterns=args.glob):
+                    yield '%s:%s'%(grp.controllers[0], grp.path), grp
+            else:
+                for grp in tree.walk('/', typs or None, patterns=args.glob):
+                    yield grp.path, grp
+        if args.stdin:
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield target(line)
+    def render(target):
+        path, grp = target
+        try:
+            values = list(grp.values(args.variable))
+        except (IOError, OSError) as e:
+            return path, None, e.errno
+        if args.json:
+            # the trailing newline of the file is not part of the value (write-only files stay null)
+            values = dict((name, cont[:-1] if cont is not None and cont.endswith('\n') else cont) for name, cont in values)
+            return path, '%s\n'%json.dumps({'path': grp.path, 'controllers': grp.controllers, 'values': values}, sort_keys=True), None
+        lines = [] if args.n else ['%s:\n'%path]
+        for name, cont in values:
+            if not args.values_only:
+                lines.append('%s: '%name)
+            lines.append('\n' if cont is None else cont)
+        return path, ''.join(lines), None
+
+    if args.json:
+        import json
+    out = BufferedOutput(logout)
+    ret = 0
+    try:
+        for path, text, err in ParallelMap(render, targets(), args.jobs):
+            if text is None:
+                sys.stderr.write('failed to read %s: %s\n'%(path, os.strerror(err)))
+                ret = 1
+                continue
+            out.write(text)
+    finally:
+        out.flush()
+    return ret
 
 def cgcreate(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
+    import argparse
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='cgcreate')
-    parser.add_argument('-g', action='append', required=True, default=[], metavar='<controllers>:<path>', help='Control group which should be added')
+    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group which should be added; braces are expanded (e.g. cpu:/slot{0..99})')
+    parser.add_argument('-f', '--file', metavar='<spec>', help='Create groups from lines of "<controllers>:<path> <name>=<value> ..." (- for stdin)')
+    parser.add_argument('-r', '--variable', metavar='<name=value>', action='append', default=[], help='Initial parameter of the groups given by -g')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of groups to create concurrently')
     parser.add_argument('-a', metavar='<tuid>:<tgid>', help='Owner of the group and all its files')
     parser.add_argument('-t', metavar='<tuid>:<tgid>', help='Owner of the tasks file')
     parser.add_argument('-s', '--tperm', metavar='mode', help='Tasks file permissions')
@@ -443,166 +1972,1770 @@ def cgcreate(logout, argv):
     # parser.add_argument('-f', '--fperm', metavar='mode', help='Group file permissions')
     args = parser.parse_args(argv)
 
-    if cgrver == 1:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            makedirs(os.path.join(cgrpath,typ,path),0o755,exist_ok=True)
-            if args.a is not None:
-                uid, gid = args.a.split(':')
-                chown(os.path.join(cgrpath,typ,path), ConvertToInt(uid), ConvertToInt(gid)) 
-            if args.t is not None:
-                uid, gid = args.t.split(':')
-                chown(os.path.join(cgrpath,typ,path,'tasks'), ConvertToInt(uid), ConvertToInt(gid))
-                chown(os.path.join(cgrpath,typ,path,'cgroup.procs'), ConvertToInt(uid), ConvertToInt(gid))
-            if args.tperm is not None:
-                os.chmod(os.path.join(cgrpath,typ,path,'tasks'), int(args.tperm, 8))
-                os.chmod(os.path.join(cgrpath,typ,path,'cgroup.procs'), int(args.tperm, 8))
-    elif cgrver == 2:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            makedirs(os.path.join(cgrpath,path),0o755,exist_ok=True)
-            if args.a is not None:
-                uid, gid = args.a.split(':')
-                chown(os.path.join(cgrpath,path), ConvertToInt(uid), ConvertToInt(gid))
-            if args.t is not None:
-                uid, gid = args.t.split(':')
-                chown(os.path.join(cgrpath,path,'cgroup.procs'), ConvertToInt(uid), ConvertToInt(gid))
-            if args.tperm is not None:
-                os.chmod(os.path.join(cgrpath,typ,path,'cgroup.procs'), int(args.tperm, 8))
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    if not args.g and args.file is None:
+        parser.error('one of -g or -f is required')
+    variables = []
+    for var in args.variable:
+        if '=' not in var:
+            parser.error('invalid variable "%s"'%var)
+        variables.append(tuple(var.split('=',1)))
+    entries = [(ParseGroup(tree, e), variables) for grp in args.g for e in ExpandBraces(grp)]
+    if args.file is not None:
+        f = sys.stdin if args.file == '-' else open(args.file, 'r')
+        try:
+            for grp, values in ReadSetSpec(f):
+                entries.extend((ParseGroup(tree, e), values) for e in ExpandBraces(grp))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    report = tree.create_many(entries, 0o755, ParseOwner(args.a), ParseOwner(args.t), None if args.tperm is None else int(args.tperm, 8), args.jobs)
+    for path, key, err in report['failed']:
+        if key is None:
+            sys.stderr.write('failed to create %s: %s\n'%(path, os.strerror(err)))
+        else:
+            sys.stderr.write('failed to set %s of %s: %s\n'%(key, path, os.strerror(err)))
+    return 1 if report['failed'] else 0
 
 def cgdelete(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
+    import argparse
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='cgdelete')
     parser.add_argument('-g', action='append', required=True, default=[], metavar='<controllers>:<path>', help='Control group to be removed')
     parser.add_argument('-r', action='store_true', help='Recursively remove all subgroups')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of groups of the same level to remove concurrently (with -r)')
+    parser.add_argument('--kill', action='store_true', help='Kill the processes in the groups first (with -r)')
+    parser.add_argument('--drain', action='store_true', help='Move the processes in the groups to the root group first (with -r)')
+    parser.add_argument('--retries', type=int, default=5, help='Number of retries for busy groups (with -r)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Report the number of removed groups and throughput')
     args = parser.parse_args(argv)
 
-    if cgrver == 1:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            if os.path.isdir(os.path.join(cgrpath,typ,path)):
-                if args.r:
-                    rmdirs(os.path.join(cgrpath,typ,path))
-                else:
-                    os.rmdir(os.path.join(cgrpath,typ,path))
-    elif cgrver == 2:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            if os.path.isdir(os.path.join(cgrpath,path)):
-                if args.r:
-                    rmdirs(os.path.join(cgrpath,path))
-                else:
-                    os.rmdir(os.path.join(cgrpath,path))
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    ret = 0
+    for grp in args.g:
+        grp = ParseGroup(tree, grp)
+        if not args.r:
+            grp.delete()
+            continue
+        try:
+            report = grp.teardown(args.jobs, 'kill' if args.kill else 'drain' if args.drain else None, args.retries)
+        except ValueError as e:
+            sys.stderr.write('%s\n'%e)
+            ret = 1
+            continue
+        for path, err in report['failed']:
+            sys.stderr.write('failed to remove %s: %s\n'%(path, os.strerror(err)))
+            ret = 1
+        if args.verbose:
+            rate = report['removed']/report['seconds'] if report['seconds'] > 0 else 0
+            logout.write('%s: removed %d groups in %.3f s (%.1f groups/s)\n'%(grp.path, report['removed'], report['seconds'], rate))
+    return ret
 
 def cgclassify(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
-    parser = argparse.ArgumentParser(prog='cgclassify')
-    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group to be used as target')
-    parser.add_argument('pids', nargs='+', type=int, help='PIDs to set cgroup')
+    tree = GetCgroupTree()
+    parsed = ParseGroupArgv(argv)
+    if parsed is not None and all(e.isdigit() for e in parsed[1]):
+        args = ParsedArgs(g=parsed[0], stdin=False, pid_file=None, jobs=None, pids=[int(e) for e in parsed[1]])
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(prog='cgclassify')
+        parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group to be used as target')
+        parser.add_argument('--stdin', action='store_true', help='Read PIDs from stdin')
+        parser.add_argument('--pid-file', metavar='<file>', help='Read PIDs from the file')
+        parser.add_argument('-j', '--jobs', type=int, help='Number of target groups to migrate into concurrently (v1 only, default: all)')
+        parser.add_argument('pids', nargs='*', type=int, help='PIDs to set cgroup')
+        args = parser.parse_args(argv)
+
+    if not args.pids and not args.stdin and args.pid_file is None:
+        sys.stderr.write('need to PIDs, --stdin or --pid-file\n')
+        return 1
+
+    targets = []
+    for grp in args.g:
+        for typ, dir in ParseGroup(tree, grp).dirs():
+            targets.append((grp, os.path.join(dir,'cgroup.procs')))
+    # v1 targets are in separate hierarchies and can be written concurrently,
+    # while in v2 the order of targets decides which group the process ends up in.
+    jobs = (args.jobs or len(targets)) if tree.version == 1 else 1
+
+    # the tokens which are not pids are reported and skipped, and make cgclassify fail
+    invalid = []
+    def batches():
+        for i in range(0, len(args.pids), 4096):
+            yield args.pids[i:i+4096]
+        if args.stdin:
+            for batch in ReadPidBatches(sys.stdin, invalid=invalid):
+                yield batch
+        if args.pid_file is not None:
+            with open(args.pid_file) as f:
+                for batch in ReadPidBatches(f, invalid=invalid):
+                    yield batch
+
+    fds = []
+    try:
+        for grp, procs in targets:
+            fds.append((grp, os.open(procs, os.O_WRONLY|os.O_APPEND)))
+        failures = []
+        for batch in batches():
+            for grp, fails in ParallelMap(lambda target: (target[0], ClassifyPids(target[1], batch)), fds, jobs):
+                failures.extend((grp, pid, err) for pid, err in fails)
+    finally:
+        for grp, fd in fds:
+            os.close(fd)
+    for grp, pid, err in failures:
+        sys.stderr.write('failed to move pid %d to %s: %s\n'%(pid, grp, os.strerror(err)))
+    return 1 if failures or invalid else 0
+
+def cgmove(logout, argv):
+    import argparse
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgmove')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Also move the processes in the descendant groups')
+    parser.add_argument('--no-freeze', action='store_true', help='Do not freeze the source group while moving')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Seconds to wait for the source group to freeze')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Report the number of moved processes and the elapsed time')
+    parser.add_argument('src', metavar='<controllers>:<path>', help='Group to move the processes from')
+    parser.add_argument('dst', metavar='<path>', help='Group to move the processes to (in the hierarchies of src)')
     args = parser.parse_args(argv)
 
-    if cgrver == 1:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            with open(os.path.join(cgrpath,typ,path,'tasks'), 'a') as f:
-                for pid in args.pids:
-                    f.write('%d\n'%pid)
-    elif cgrver == 2:
-        for grp in args.g:
-            typ, path = grp.split(':')
-            if typ.startswith('/'):
-                typ = typ[1:]
-            if path.startswith('/'):
-                path = path[1:]
-            with open(os.path.join(cgrpath,path,'tasks'), 'a') as f:
-                for pid in args.pids:
-                    f.write('%d\n'%pid)
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    src = ParseGroup(tree, args.src) if ':' in args.src else tree.group(args.src)
+    dst = args.dst.split(':',1)[1] if ':' in args.dst else args.dst
+    if dst.strip('/') == src.rel or args.recursive and src.contains(dst):
+        sys.stderr.write('%s is in the source group %s\n'%(dst, src.path))
+        return 1
+    target = tree.group(dst, src.controllers)
+    if not all(os.path.isdir(tdir) for (typ, dir), (ttyp, tdir) in zip(src.dirs(), target.dirs()) if os.path.isdir(dir)):
+        sys.stderr.write('%s does not exist\n'%dst)
+        return 1
+    report = src.move(dst, args.recursive, not args.no_freeze, args.timeout)
+    for pid, err in report['failed']:
+        sys.stderr.write('failed to move pid %d to %s: %s\n'%(pid, dst, os.strerror(err)))
+    if args.verbose:
+        logout.write('%s: moved %d processes to %s in %.3f ms%s\n'%(src.path, report['moved'], dst, report['seconds']*1000, ' (frozen)' if report['frozen'] else ''))
+    return 1 if report['failed'] else 0
 
 def lssubsys(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
+    import argparse
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='lssubsys')
     args = parser.parse_args(argv)
 
-    if cgrver == 1:
-        for typ in sorted(os.listdir(cgrpath)):
-            if os.path.isdir(os.path.join(cgrpath,typ)) and not os.path.islink(os.path.join(cgrpath,typ)):
-                logout.write('%s\n'%typ)
-    elif cgrver == 2:
-        pass
-    else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+    if tree.version == 1:
+        for typ in tree.controllers:
+            logout.write('%s\n'%typ)
 
 def lscgroup(logout, argv):
-    cgrpath, cgrver = GetCgroupMount()
+    import argparse
+    tree = GetCgroupTree()
     parser = argparse.ArgumentParser(prog='lscgroup')
+    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group to be listed (default: all)')
+    parser.add_argument('group', nargs='*', metavar='<controllers>:<path>', help='Control group to be listed')
+    parser.add_argument('-d', '--depth', type=int, help='Maximum depth to descend below the group')
+    parser.add_argument('--glob', action='append', default=[], metavar='<pattern>', help='Only list groups whose path matches the pattern (non-matching subtrees are not scanned)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of threads to walk v1 controllers with')
     args = parser.parse_args(argv)
 
-    if cgrver == 1:
-        for typ in sorted(os.listdir(cgrpath)):
-            if os.path.isdir(os.path.join(cgrpath,typ)) and not os.path.islink(os.path.join(cgrpath,typ)):
-                for curDir, dirs, files in os.walk(os.path.join(cgrpath,typ)):
-                    for dir in dirs:
-                        logout.write('%s:%s\n'%(typ,os.path.join(curDir,dir)[len(os.path.join(cgrpath,typ)):]))
-    elif cgrver == 2:
-        for curDir, dirs, files in os.walk(cgrpath):
-            for dir in dirs:
-                logout.write(':%s\n'%(os.path.join(curDir,dir)[len(cgrpath):]))
+    grps = []
+    for grp in args.g+args.group:
+        typ, path = grp.split(':',1) if ':' in grp else (grp, '')
+        grps.append((typ or None, path))
+    if not grps:
+        grps = [(None, '')]
+
+    for typ, path in grps:
+        typs = None
+        if tree.version == 1:
+            typs = ResolveHierarchies(tree, typ) if typ else tree.controllers
+            if not typs:
+                # an empty list would mean all the hierarchies to walk()
+                continue
+        for grp in tree.walk(path, typs, args.depth, args.glob, args.jobs):
+            logout.write('%s:%s\n'%(grp.controllers[0] if tree.version == 1 else '', grp.path))
+
+# {hierarchy: path} of a /proc/<pid>/cgroup. hierarchy is '' for v2 ("0::/path"); v1 lines such as
+# "3:cpu,cpuacct:/path" are stored under "cpu,cpuacct" and each of its controllers, and "name=systemd" as is.
+def ParseProcCgroup(data, paths=None):
+    result = {}
+    for line in data.splitlines():
+        cols = line.split(':', 2)
+        if len(cols) != 3:
+            continue
+        path = cols[2] if paths is None else paths.setdefault(cols[2], cols[2])
+        result[cols[1]] = path
+        if ',' in cols[1]:
+            for typ in cols[1].split(','):
+                result[typ] = path
+    return result
+
+# pid -> cgroup index built in one pass over /proc/*/cgroup, and subtree memberships from cgroup.procs.
+# both are reused for ttl seconds, so that repeated queries (e.g. of a scheduler through the daemon) are cheap.
+class ProcessIndex(object):
+    def __init__(self, tree=None, ttl=1.0):
+        self.tree = tree or GetCgroupTree()
+        self.ttl = ttl
+        self.built = None
+        self.pids = {}
+        self.memberships = {}
+
+    def refresh(self):
+        import time
+        pids = {}
+        # the same path strings are shared by all the pids in a group
+        paths = {}
+        for pid in ScanPids():
+            try:
+                pids[pid] = ParseProcCgroup(ReadControlFile('/proc/%d/cgroup'%pid), paths)
+            except (IOError, OSError):
+                # exited
+                continue
+        self.pids = pids
+        self.memberships = {}
+        self.built = time.time()
+
+    def fresh(self):
+        import time
+        return self.built is not None and time.time()-self.built < self.ttl
+
+    # {pid: {hierarchy: path}} of every process (see ParseProcCgroup()).
+    def index(self):
+        if not self.fresh():
+            self.refresh()
+        return self.pids
+
+    # {hierarchy: path} of pid, or None if it does not exist. unless the index is fresh, only /proc/<pid>/cgroup is read.
+    def groups(self, pid):
+        if self.fresh():
+            return self.pids.get(pid)
+        try:
+            return ParseProcCgroup(ReadControlFile('/proc/%d/cgroup'%pid))
+        except (IOError, OSError):
+            return None
+
+    # path of the group of pid in the hierarchy of controller (v2: ''; v1: e.g. 'memory'), or None.
+    def group(self, pid, controller=''):
+        groups = self.groups(pid)
+        return None if groups is None else groups.get(controller)
+
+    # pids in the Cgroup grp (with recursive, also in its descendants).
+    def members(self, grp, recursive=True):
+        import time
+        key = (grp.path, tuple(grp.controllers or ()), recursive)
+        cached = self.memberships.get(key)
+        if cached is None or time.time()-cached[0] >= self.ttl:
+            cached = self.memberships[key] = (time.time(), grp.members(recursive))
+        return cached[1]
+
+processIndex = None
+def GetProcessIndex(ttl=1.0):
+    global processIndex
+    if processIndex is None or processIndex.tree is not GetCgroupTree():
+        processIndex = ProcessIndex(GetCgroupTree(), ttl)
+    processIndex.ttl = ttl
+    return processIndex
+
+def cgps(logout, argv):
+    import argparse
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgps')
+    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='List the processes in the group')
+    parser.add_argument('-r', '--recursive', action='store_true', help='With -g, include the processes in descendant groups')
+    parser.add_argument('-c', '--controller', metavar='<controller>', help='Hierarchy to print the groups of (v1; default: all)')
+    parser.add_argument('--ttl', type=float, default=1.0, help='Seconds to reuse the index for when served by the daemon')
+    parser.add_argument('--json', action='store_true', help='Print a JSON object of pid to {hierarchy: path}')
+    parser.add_argument('pid', nargs='*', type=int, help='Print the groups of the processes (default: all processes)')
+    args = parser.parse_args(argv)
+
+    index = GetProcessIndex(args.ttl)
+    pids = args.pid
+    if args.g:
+        pids = sorted(set(pid for grp in args.g for pid in index.members(ParseGroup(tree, grp), args.recursive)))
+        if not args.json and args.controller is None:
+            for pid in pids:
+                logout.write('%d\n'%pid)
+            return 0
+    if not pids and not args.g:
+        result = sorted(index.index().items())
     else:
-        raise NotImplementedError('unknown cgroup version %d'%cgrver)
+        # a handful of pids are cheaper to look up one by one than by building the index
+        if len(pids) > 16:
+            index.index()
+        result = [(pid, index.groups(pid)) for pid in pids]
+    if args.controller is not None:
+        result = [(pid, grps if grps is None else dict((typ, grps[typ]) for typ in grps if typ == args.controller)) for pid, grps in result]
+    if args.json:
+        import json
+        logout.write('%s\n'%json.dumps(dict((str(pid), grps) for pid, grps in result), sort_keys=True))
+        return 0
+    ret = 0
+    for pid, grps in result:
+        if grps is None:
+            sys.stderr.write('no such process: %d\n'%pid)
+            ret = 1
+            continue
+        for typ in sorted(grps):
+            # combined hierarchies are printed as each of their controllers
+            if ',' in typ and args.controller is None:
+                continue
+            logout.write('%d %s:%s\n'%(pid, typ, grps[typ]))
+    return ret
+
+def ConvertToNumber(val):
+    try:
+        return int(val)
+    except ValueError:
+        try:
+            return float(val)
+        except ValueError:
+            return None
+
+# parses flat ("1234"), keyed ("usage_usec 1234") and nested keyed ("8:0 rbytes=1 wbytes=2") files
+# into a list of (name, label, value). label is the first column of nested keyed lines (device or kind).
+def ParseStat(name, data):
+    result = []
+    for line in data.splitlines():
+        cols = line.split()
+        if len(cols) == 1:
+            val = ConvertToNumber(cols[0])
+            if val is not None:
+                result.append((name, None, val))
+        elif len(cols) == 2 and '=' not in cols[1]:
+            val = ConvertToNumber(cols[1])
+            if val is not None:
+                result.append(('%s.%s'%(name,cols[0]), None, val))
+        else:
+            for col in cols[1:]:
+                k, sep, v = col.partition('=')
+                val = ConvertToNumber(v) if sep else None
+                if val is not None:
+                    result.append(('%s.%s'%(name,k), cols[0], val))
+    return result
+
+# keeps the control files open and re-reads them from offset 0 into a single reused buffer on each sample().
+# files is a list of (group, name, path).
+class StatSampler(object):
+    def __init__(self, files, bufsize=65536):
+        self.files = []
+        self.buf = bytearray(bufsize)
+        # one fd per file is kept, so raise the soft limit as far as allowed
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < len(files)+64:
+            want = len(files)+64 if hard == resource.RLIM_INFINITY else min(len(files)+64, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+        try:
+            for group, name, path in files:
+                try:
+                    self.files.append((group, name, os.open(path, os.O_RDONLY)))
+                except OSError as e:
+                    if e.errno not in [errno.ENOENT, errno.EACCES]:
+                        raise
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, fd):
+        if hasattr(os, 'preadv'):
+            while True:
+                n = os.preadv(fd, [self.buf], 0)
+                if n < len(self.buf):
+                    return self.buf[:n].decode('utf-8', 'replace')
+                self.buf = bytearray(len(self.buf)*2)
+        elif hasattr(os, 'pread'):
+            return os.pread(fd, 1<<20, 0).decode('utf-8', 'replace')
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            return os.read(fd, 1<<20).decode('utf-8', 'replace')
+
+    # returns {group: {(name, label): value}}
+    def sample(self):
+        result = {}
+        for group, name, fd in self.files:
+            try:
+                data = self.read(fd)
+            except OSError as e:
+                # the group was removed
+                if e.errno in [errno.ENODEV, errno.ENOENT]:
+                    continue
+                raise
+            values = result.setdefault(group, {})
+            for key, label, val in ParseStat(name, data):
+                values[(key, label)] = val
+        return result
+
+    def close(self):
+        for group, name, fd in self.files:
+            os.close(fd)
+        self.files = []
+
+# sorted [(group, name, path)] of the control files of grps to sample for StatSampler: those in variables, or by default
+# *.stat, *.current, *.events, *.usage and *.usage_in_bytes. group is '<controller>:<path>' in v1.
+def StatFiles(grps, variables=None):
+    files = []
+    for grp in grps:
+        for typ, dir in grp.dirs():
+            if not os.path.isdir(dir):
+                continue
+            group = '%s:%s'%(typ,grp.path) if grp.tree.version == 1 else grp.path
+            prefixes = tuple(e+'.' for e in ([typ] if typ else grp.controllers or []))
+            for ent in scandir(dir):
+                if not ent.is_file() or prefixes and not ent.name.startswith(prefixes):
+                    continue
+                if ent.name in variables if variables else ent.name.endswith(('.stat', '.current', '.events', '.usage', '.usage_in_bytes')):
+                    files.append((group, ent.name, ent.path))
+    files.sort()
+    return files
+
+def FormatStatKey(key, label):
+    return key if label is None else '%s{%s}'%(key,label)
+
+def cgstat(logout, argv):
+    import argparse
+    import time
+    import json
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgstat')
+    parser.add_argument('-g', action='append', default=[], metavar='<controllers>:<path>', help='Control group to be sampled')
+    parser.add_argument('-r', '--variable', metavar='<name>', action='append', default=[], help='Control file to be sampled (default: *.stat, *.current, *.events, *.usage, *.usage_in_bytes)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0, help='Seconds between samples')
+    parser.add_argument('-c', '--count', type=int, help='Number of intervals to report (default: infinite)')
+    parser.add_argument('-f', '--format', choices=['text', 'json', 'prometheus'], default='text', help='Output format')
+    parser.add_argument('-o', '--output', metavar='<file>', help='Atomically replace the file with each report instead of writing to stdout (e.g. for textfile collectors)')
+    parser.add_argument('path', nargs='*', help='Control group')
+    args = parser.parse_args(argv)
+
+    grps = []
+    for path in args.path:
+        grps.append(tree.group(path))
+    for grp in args.g:
+        typ, path = grp.split(':',1)
+        grps.append(tree.group(path, typ.split(',') if typ else None))
+    files = StatFiles(grps, args.variable)
+
+    monotonic = getattr(time, 'monotonic', time.time)
+    sampler = StatSampler(files)
+    try:
+        prev = sampler.sample()
+        prevtime = start = monotonic()
+        n = 0
+        while args.count is None or n < args.count:
+            n += 1
+            delay = start + n*args.interval - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            cur = sampler.sample()
+            curtime = monotonic()
+            dt = curtime - prevtime
+            now = time.time()
+            out = []
+            for group in sorted(cur):
+                values = cur[group]
+                before = prev.get(group, {})
+                deltas = dict((k, v-before[k]) for k, v in values.items() if k in before)
+                if args.format == 'json':
+                    out.append('%s\n'%json.dumps({
+                        'time': now,
+                        'interval': dt,
+                        'cgroup': group,
+                        'values': dict((FormatStatKey(*k), v) for k, v in values.items()),
+                        'deltas': dict((FormatStatKey(*k), v) for k, v in deltas.items()),
+                        'rates': dict((FormatStatKey(*k), v/dt) for k, v in deltas.items()),
+                    }, sort_keys=True))
+                elif args.format == 'prometheus':
+                    for key, label in sorted(values, key=lambda e: (e[0], e[1] or '')):
+                        metric = 'cgroup_%s'%key.replace('.','_').replace('-','_')
+                        labels = 'cgroup="%s"'%group.replace('\\','\\\\').replace('"','\\"')
+                        if label is not None:
+                            labels += ',%s="%s"'%('device' if key.startswith('io.') or key.startswith('blkio.') else 'key', label)
+                        out.append('%s{%s} %s\n'%(metric, labels, values[(key, label)]))
+                        if (key, label) in deltas:
+                            out.append('%s_rate{%s} %s\n'%(metric, labels, deltas[(key, label)]/dt))
+                else:
+                    for k in sorted(values, key=lambda e: (e[0], e[1] or '')):
+                        if k in deltas:
+                            out.append('%s %s %s %+g %g/s\n'%(group, FormatStatKey(*k), values[k], deltas[k], deltas[k]/dt))
+                        else:
+                            out.append('%s %s %s\n'%(group, FormatStatKey(*k), values[k]))
+            if args.output is not None:
+                with open(args.output+'.tmp', 'w') as f:
+                    f.write(''.join(out))
+                os.rename(args.output+'.tmp', args.output)
+            else:
+                logout.write(''.join(out))
+                logout.flush()
+            prev, prevtime = cur, curtime
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sampler.close()
+
+IN_MODIFY = 0x00000002
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# watches cgroup.events-like keyed files of the groups in a subtree with inotify (v2 only).
+# read() returns a list of events such as
+#   {'cgroup': '/a/b', 'event': 'created'}
+#   {'cgroup': '/a/b', 'event': 'populated', 'file': 'cgroup.events', 'old': 1, 'new': 0}
+#   {'cgroup': '/a/b', 'event': 'oom_kill', 'file': 'memory.events', 'old': 0, 'new': 1}
+# and fileno() can be passed to select()/event loops.
+class CgroupWatcher(object):
+    def __init__(self, top, prefix='', files=('cgroup.events', 'memory.events', 'pids.events'), recursive=True):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.files = files
+        self.recursive = recursive
+        self.wds = {}
+        self.groups = {}
+        self.values = {}
+        self.pending = []
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            self.addGroup(top, prefix or '/', False)
+        except Exception:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def addWatch(self, path, mask):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def addGroup(self, dir, group, created):
+        # the directory is watched before scanning so that a child created meanwhile is not missed
+        try:
+            if self.recursive:
+                self.wds[self.addWatch(dir, IN_CREATE|IN_DELETE|IN_ONLYDIR)] = (group, None)
+            self.groups[group] = dir
+            if created:
+                self.pending.append({'cgroup': group, 'event': 'created'})
+            for name in self.files:
+                path = os.path.join(dir, name)
+                if os.path.exists(path):
+                    self.wds[self.addWatch(path, IN_MODIFY)] = (group, name)
+                    self.values[(group, name)] = ReadKeyed(path)
+            if self.recursive:
+                for ent in scandir(dir):
+                    if ent.is_dir(follow_symlinks=False):
+                        self.addGroup(ent.path, group.rstrip('/')+'/'+ent.name, created)
+        except OSError as e:
+            # removed before it could be watched
+            if e.errno not in [errno.ENOENT, errno.ENODEV]:
+                raise
+
+    def removeGroup(self, group):
+        for key in [e for e in self.groups if e == group or e.startswith(group+'/')]:
+            del self.groups[key]
+            self.pending.append({'cgroup': key, 'event': 'removed'})
+        for key in [e for e in self.values if e[0] == group or e[0].startswith(group+'/')]:
+            del self.values[key]
+
+    def update(self, group, name):
+        try:
+            new = ReadKeyed(os.path.join(self.groups[group], name))
+        except (IOError, OSError) as e:
+            if e.errno not in [errno.ENOENT, errno.ENODEV]:
+                raise
+            return
+        old = self.values.get((group, name), {})
+        self.values[(group, name)] = new
+        for key in sorted(new):
+            if new[key] != old.get(key):
+                self.pending.append({'cgroup': group, 'event': key, 'file': name, 'old': old.get(key), 'new': new[key]})
+
+    # waits up to timeout seconds (forever if None) and returns the list of events (empty on timeout).
+    def read(self, timeout=None):
+        import select
+        if not self.pending:
+            try:
+                r, w, x = select.select([self.fd], [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                r = []
+            if r:
+                try:
+                    data = os.read(self.fd, 65536)
+                except OSError as e:
+                    if e.errno!=errno.EAGAIN:
+                        raise
+                    data = b''
+                self.dispatch(data)
+        events, self.pending = self.pending, []
+        return events
+
+    def dispatch(self, data):
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; compare every file with its last value
+                for group, name in list(self.values):
+                    self.update(group, name)
+                continue
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if wd not in self.wds:
+                continue
+            group, file = self.wds[wd]
+            if file is None:
+                if mask & IN_ISDIR and group in self.groups:
+                    child = group.rstrip('/')+'/'+name
+                    if mask & IN_CREATE and child not in self.groups:
+                        self.addGroup(os.path.join(self.groups[group], name), child, True)
+                    elif mask & IN_DELETE:
+                        self.removeGroup(child)
+            elif mask & IN_MODIFY and group in self.groups:
+                self.update(group, file)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __iter__(self):
+        while True:
+            for event in self.read():
+                yield event
+
+def cgwatch(logout, argv):
+    import argparse
+    import time
+    import json
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgwatch')
+    parser.add_argument('-r', '--variable', metavar='<name>', action='append', default=[], help='Events file to be watched (default: cgroup.events, memory.events, pids.events)')
+    parser.add_argument('-n', '--no-recursive', action='store_true', help='Do not watch child groups')
+    parser.add_argument('-f', '--format', choices=['text', 'json'], default='text', help='Output format')
+    parser.add_argument('path', nargs='?', default='/', help='Control group (default: root)')
+    args = parser.parse_args(argv)
+
+    if tree.version != 2:
+        sys.stderr.write('cgwatch requires cgroup v2\n')
+        return 1
+    grp = tree.group(args.path)
+    watcher = CgroupWatcher(grp.dirs()[0][1], grp.path, args.variable or ('cgroup.events', 'memory.events', 'pids.events'), not args.no_recursive)
+    try:
+        for event in watcher:
+            if args.format == 'json':
+                event['time'] = time.time()
+                logout.write('%s\n'%json.dumps(event, sort_keys=True))
+            elif 'file' in event:
+                logout.write('%s %s %s %s -> %s\n'%(event['cgroup'], event['file'], event['event'], event['old'], event['new']))
+            else:
+                logout.write('%s %s\n'%(event['cgroup'], event['event']))
+            logout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+# a cgsnapshot() entry as a libcgroup config "group" block. in v1 a group is written as a block per hierarchy.
+# values are grouped by their controller; perm is written only for groups not owned by root.
+def FormatConfigGroup(snap):
+    lines = ['group %s {'%(snap['path'].strip('/') or '.')]
+    if snap['owner'] != (0, 0) or snap['task_owner'] != (0, 0):
+        lines += [
+            '\tperm {',
+            '\t\ttask {', '\t\t\tuid = %d;'%snap['task_owner'][0], '\t\t\tgid = %d;'%snap['task_owner'][1], '\t\t\tfperm = %04o;'%snap['fperm'], '\t\t}',
+            '\t\tadmin {', '\t\t\tuid = %d;'%snap['owner'][0], '\t\t\tgid = %d;'%snap['owner'][1], '\t\t\tdperm = %04o;'%snap['dperm'], '\t\t}',
+            '\t}',
+        ]
+    typ = None
+    for name, cont in snap['values']:
+        if name.split('.')[0] != typ:
+            if typ is not None:
+                lines.append('\t}')
+            typ = name.split('.')[0]
+            lines.append('\t%s {'%typ)
+        lines.append('\t\t%s="%s";'%(name, cont.rstrip('\n').replace('\\', '\\\\').replace('"', '\\"')))
+    if typ is not None:
+        lines.append('\t}')
+    lines.append('}\n\n')
+    return '\n'.join(lines)
+
+def FormatJsonGroup(snap):
+    import json
+    return json.dumps(dict(snap, values=[[name, cont] for name, cont in snap['values']]), sort_keys=True)+'\n'
+
+# tokens of a libcgroup config: '{', '}', '=', ';' and words; quoted strings are unescaped and kept with their '"'.
+def TokenizeConfig(text):
+    import re
+    tokens = []
+    for token in re.findall(r'#[^\n]*|"(?:[^"\\]|\\.)*"|[{}=;]|[^\s{}=;"#]+', text):
+        if token.startswith('"'):
+            token = token[:-1]
+            if '\\' in token:
+                token = re.sub(r'\\(.)', r'\1', token)
+        elif token.startswith('#'):
+            continue
+        tokens.append(token)
+    return tokens
+
+# nested statements of a libcgroup config as [(words, value)]: 'cpu.shares = "1";' -> (['cpu.shares'], '1'),
+# 'group a { ... }' -> (['group', 'a'], [statements]).
+def ParseConfigBlock(tokens, pos=0):
+    items = []
+    while pos < len(tokens) and tokens[pos] != '}':
+        words = []
+        while pos < len(tokens) and tokens[pos] not in ['{', '}', '=', ';']:
+            words.append(tokens[pos].lstrip('"'))
+            pos += 1
+        if pos >= len(tokens) or tokens[pos] == '}':
+            raise ValueError('unexpected end of statement after %s'%' '.join(words))
+        if tokens[pos] == '=':
+            if pos+2 >= len(tokens) or tokens[pos+2] != ';':
+                raise ValueError('missing ";" after %s'%' '.join(words))
+            items.append((words, tokens[pos+1].lstrip('"') if tokens[pos+1].startswith('"') else tokens[pos+1]))
+            pos += 3
+        elif tokens[pos] == '{':
+            block, pos = ParseConfigBlock(tokens, pos+1)
+            if pos >= len(tokens):
+                raise ValueError('missing "}" after %s'%' '.join(words))
+            items.append((words, block))
+            pos += 1
+        else:
+            pos += 1
+    return items, pos
+
+# ids of uid/gid values of a config, which may be names or numbers. lookups are cached.
+configOwners = {}
+# an id not given (None) is left as is by converge().
+def ConfigOwner(uid, gid):
+    if (uid, gid) not in configOwners:
+        configOwners[uid, gid] = ResolveOwner((None if uid is None else ConvertToInt(uid), None if gid is None else ConvertToInt(gid)))
+    return configOwners[uid, gid]
+
+# groups of a libcgroup config, or of a cgsnapshot -F jsonl stream, in the form of Cgroup.snapshot():
+# [{'path', 'controllers', 'values', 'owner', 'task_owner', 'dperm', 'fperm'}], with None for what is not given.
+# a group given more than once (as cgsnapshot does for the v1 hierarchies) is merged. mount, template and namespace
+# sections are ignored; the perm of the "default" section is applied to groups without one.
+def LoadConfig(text):
+    import collections
+    groups = collections.OrderedDict()
+    def merge(entry):
+        cur = groups.setdefault(entry['path'], {'path': entry['path'], 'controllers': None, 'values': [], 'owner': None, 'task_owner': None, 'dperm': None, 'fperm': None})
+        if entry.get('controllers'):
+            cur['controllers'] = sorted(set(cur['controllers'] or [])|set(entry['controllers']))
+        cur['values'].extend(tuple(e) for e in entry.get('values', []))
+        for key in ['owner', 'task_owner', 'dperm', 'fperm']:
+            if entry.get(key) is not None and cur[key] is None:
+                cur[key] = tuple(entry[key]) if isinstance(entry[key], list) else entry[key]
+    if text.lstrip().startswith('{'):
+        import json
+        for line in text.splitlines():
+            if line.strip():
+                merge(json.loads(line))
+        return list(groups.values())
+    def perm(block):
+        entry = {}
+        for words, value in block:
+            if words == ['task'] or words == ['admin']:
+                fields = dict((e[0][0], e[1]) for e in value if not isinstance(e[1], list))
+                if 'uid' in fields or 'gid' in fields:
+                    entry['task_owner' if words == ['task'] else 'owner'] = ConfigOwner(fields.get('uid'), fields.get('gid'))
+                if words == ['task'] and 'fperm' in fields:
+                    entry['fperm'] = int(fields['fperm'], 8)
+                if words == ['admin'] and 'dperm' in fields:
+                    entry['dperm'] = int(fields['dperm'], 8)
+        return entry
+    default = {}
+    tokens = TokenizeConfig(text)
+    items, pos = ParseConfigBlock(tokens)
+    if pos < len(tokens):
+        raise ValueError('unexpected "}"')
+    for words, value in items:
+        if words[0] == 'default' and isinstance(value, list):
+            for w, v in value:
+                if w == ['perm']:
+                    default = perm(v)
+        if words[0] != 'group' or len(words) != 2 or not isinstance(value, list):
+            continue
+        entry = {'path': '/' if words[1] == '.' else '/'+words[1].strip('/'), 'controllers': [], 'values': []}
+        for w, v in value:
+            if w == ['perm']:
+                entry.update(perm(v))
+            elif len(w) == 1 and isinstance(v, list):
+                entry['controllers'].append(w[0])
+                entry['values'].extend((e[0][0], e[1]) for e in v if not isinstance(e[1], list))
+        merge(entry)
+    for entry in groups.values():
+        if entry['owner'] is None and entry['task_owner'] is None:
+            for key in default:
+                entry[key] = default[key]
+    return list(groups.values())
 
 def cgsnapshot(logout, argv):
-    raise NotImplementedError()
+    import argparse
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgsnapshot')
+    parser.add_argument('-s', '--silent', action='store_true', help='Do not write the header comment and mount section')
+    parser.add_argument('-f', '--file', metavar='<output>', help='Write the snapshot to the file instead of stdout')
+    parser.add_argument('-g', '--group', default='/', metavar='<path>', help='Snapshot the subtree of the group only')
+    parser.add_argument('-F', '--format', choices=['conf', 'jsonl'], default='conf', help='libcgroup config (default) or a JSON object per group and line')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of groups to read concurrently')
+    parser.add_argument('controller', nargs='*', help='Controllers to snapshot (default: all)')
+    args = parser.parse_args(argv)
+
+    out = logout if args.file is None else open(args.file, 'w')
+    try:
+        if args.format == 'conf' and not args.silent:
+            out.write('# Configuration file generated by cgsnapshot\n')
+            if tree.version == 1:
+                out.write('mount {\n')
+                for typ in args.controller or tree.controllers:
+                    out.write('\t%s = %s;\n'%(typ, os.path.join(tree.root,typ)))
+                out.write('}\n\n')
+        # groups are yielded in walk order while up to jobs*4 of them are being read, so memory does not grow with the tree
+        def groups():
+            if args.group.strip('/'):
+                if tree.version == 1:
+                    for typ in args.controller or tree.controllers:
+                        grp = tree.group(args.group, [typ])
+                        if grp.exists():
+                            yield grp
+                else:
+                    yield tree.group(args.group)
+            for grp in tree.walk(args.group, args.controller or None):
+                yield grp
+        def snapshot(grp):
+            try:
+                return grp.snapshot()
+            except (IOError, OSError, IndexError):
+                # removed while walking
+                return None
+        format = FormatConfigGroup if args.format == 'conf' else FormatJsonGroup
+        for snap in ParallelMap(snapshot, groups(), args.jobs):
+            if snap is not None:
+                out.write(format(snap))
+    finally:
+        if out is not logout:
+            out.close()
 
 def cgclear(logout, argv):
-    raise NotImplementedError()
+    import argparse
+    import time
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgclear')
+    parser.add_argument('-g', '--group', default='/', metavar='<path>', help='Remove the group and its descendants instead of all groups')
+    parser.add_argument('--kill', action='store_true', help='Kill the processes in the groups instead of moving them to the root group')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of groups of the same level to remove concurrently')
+    parser.add_argument('--retries', type=int, default=5, help='Number of retries for busy groups')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Print the groups which would be removed, in removal order')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Report the number of removed groups and throughput')
+    parser.add_argument('controller', nargs='*', help='Controllers to clear (default: all)')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    if args.group.strip('/'):
+        grps = [tree.group(args.group, [typ]) for typ in (args.controller or tree.controllers)] if tree.version == 1 else [tree.group(args.group)]
+    else:
+        grps = list(tree.walk('/', args.controller or None, depth=1))
+    # the tree is walked once; the same listing is used to move the processes out and to remove the groups
+    trees = [(grp, TreeLevels([dir for typ, dir in grp.dirs()])) for grp in grps]
+    levels = {}
+    for grp, lv in trees:
+        for depth in lv:
+            levels.setdefault(depth, []).extend(lv[depth])
+    if args.dry_run:
+        for depth in sorted(levels, reverse=True):
+            for dir in levels[depth]:
+                logout.write('%s\n'%dir)
+        return 0
+    ret = 0
+    for grp, lv in trees:
+        if not lv:
+            continue
+        if args.kill:
+            if not grp.kill():
+                sys.stderr.write('failed to kill the processes in %s\n'%grp.path)
+                ret = 1
+            continue
+        for pid, err in MigrateProcs([dir for depth in lv for dir in lv[depth]], tree.group('/', grp.controllers).dirs()[0][1])[1]:
+            sys.stderr.write('failed to move %d: %s\n'%(pid, os.strerror(err)))
+            ret = 1
+    removed, failures = RemoveLevels(levels, args.jobs, args.retries)
+    for path, err in failures:
+        sys.stderr.write('failed to remove %s: %s\n'%(path, os.strerror(err)))
+        ret = 1
+    if args.verbose:
+        elapsed = time.time()-start
+        logout.write('removed %d groups in %.3f s (%.1f groups/s)\n'%(removed, elapsed, removed/elapsed if elapsed > 0 else 0))
+    return ret
 
 def cgconfigparser(logout, argv):
-    raise NotImplementedError()
+    import argparse
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgconfigparser')
+    parser.add_argument('-l', '--load', metavar='<file>', action='append', default=[], help='Apply a libcgroup config or a cgsnapshot output (- for stdin)')
+    parser.add_argument('-L', '--load-directory', metavar='<dir>', action='append', default=[], help='Apply all files in the directory')
+    parser.add_argument('-a', metavar='<tuid>:<tgid>', help='Default owner of the groups without perm')
+    parser.add_argument('-d', '--dperm', metavar='mode', help='Default directory permissions of the groups without perm')
+    parser.add_argument('-t', metavar='<tuid>:<tgid>', help='Default owner of the tasks file of the groups without perm')
+    parser.add_argument('-s', '--tperm', metavar='mode', help='Default tasks file permissions of the groups without perm')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of top level subtrees to apply concurrently')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print created groups and written variables')
+    args = parser.parse_args(argv)
+
+    files = list(args.load)
+    for dir in args.load_directory:
+        files.extend(sorted(os.path.join(dir,e) for e in os.listdir(dir) if os.path.isfile(os.path.join(dir,e))))
+    if not files:
+        parser.error('one of -l or -L is required')
+    groups = []
+    for file in files:
+        if file == '-':
+            text = sys.stdin.read()
+        else:
+            with open(file, 'r') as f:
+                text = f.read()
+        try:
+            groups.extend(LoadConfig(text))
+        except ValueError as e:
+            sys.stderr.write('%s: %s\n'%(file, e))
+            return 1
+    defaults = {'owner': ResolveOwner(ParseOwner(args.a)), 'task_owner': ResolveOwner(ParseOwner(args.t)), 'dperm': None if args.dperm is None else int(args.dperm, 8), 'fperm': None if args.tperm is None else int(args.tperm, 8)}
+    for group in groups:
+        if group['owner'] is None and group['task_owner'] is None:
+            for key in defaults:
+                if group[key] is None:
+                    group[key] = defaults[key]
+
+    # parents are applied before their children and the top level subtrees are independent of each other
+    subtrees = {}
+    for group in sorted(groups, key=lambda e: e['path'].strip('/').count('/') if e['path'].strip('/') else -1):
+        subtrees.setdefault(group['path'].strip('/').split('/')[0], []).append((tree.group(group['path'], group['controllers']), group))
+    failed = tree.prepare([(grp, group['values']) for key in sorted(subtrees) for grp, group in subtrees[key]])
+    def apply(entries):
+        results = []
+        for grp, group in entries:
+            results.append((grp, grp.converge(group['values'], group['owner'], group['task_owner'], group['dperm'], group['fperm'])))
+        return results
+    ret = 0
+    for path, key, err in failed:
+        sys.stderr.write('failed to prepare %s: %s\n'%(path, os.strerror(err)))
+        ret = 1
+    for results in ParallelMap(apply, [subtrees[key] for key in sorted(subtrees)], args.jobs):
+        for grp, (created, written, failures) in results:
+            if args.verbose:
+                if created:
+                    logout.write('created %s\n'%grp.path)
+                for key in written:
+                    logout.write('written %s %s\n'%(grp.path, key))
+            for key, err in failures:
+                if key is None:
+                    sys.stderr.write('failed to create %s: %s\n'%(grp.path, os.strerror(err)))
+                else:
+                    sys.stderr.write('failed to set %s of %s: %s\n'%(key, grp.path, os.strerror(err)))
+                ret = 1
+    return ret
+
+# cgrules.conf compiled into a dict keyed by (kind, id, process) with kind 'u' (uid), 'g' (gid) or '*', and process
+# None for any process. only the first rule of a key can ever match, so match() needs a few lookups per process
+# instead of a scan of the rules: the matching rule is the earliest of the keys present.
+# a rule is (line number, [(controllers or None for all, destination)]); '%' lines add destinations to the previous rule.
+class CgroupRules(object):
+    def __init__(self, lines):
+        import pwd
+        import grp
+        self.index = {}
+        rule = None
+        for number, line in enumerate(lines, 1):
+            cols = line.split('#',1)[0].split()
+            if not cols:
+                continue
+            if len(cols) != 3:
+                raise ValueError('line %d: expected "<user>[:<process>] <controllers> <destination>"'%number)
+            who, controllers, dest = cols
+            controllers = None if controllers == '*' else controllers.split(',')
+            if who == '%':
+                if rule is None:
+                    raise ValueError('line %d: "%%" without a previous rule'%number)
+                rule[1].append((controllers, dest))
+                continue
+            user, _, process = who.partition(':')
+            try:
+                if user == '*':
+                    key = ('*', None)
+                elif user.startswith('@'):
+                    key = ('g', ConvertToInt(user[1:]) if user[1:].isdigit() else grp.getgrnam(user[1:]).gr_gid)
+                else:
+                    key = ('u', ConvertToInt(user) if user.isdigit() else pwd.getpwnam(user).pw_uid)
+            except KeyError:
+                # like libcgroup, rules of unknown users and groups are skipped
+                sys.stderr.write('line %d: unknown user or group %s\n'%(number, user))
+                rule = None
+                continue
+            rule = (number, [(controllers, dest)])
+            self.index.setdefault(key+(process or None,), rule)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(f)
+
+    # destinations of the first rule matching a process, or None.
+    # process names of rules are compared with comm, the path of the executable and its basename.
+    def match(self, uid, gids, comm, exe):
+        names = [None, comm]
+        if exe is not None:
+            names += [exe, os.path.basename(exe)]
+        keys = [('u', uid)]+[('g', gid) for gid in gids]+[('*', None)]
+        best = None
+        for kind, id in keys:
+            for name in names:
+                rule = self.index.get((kind, id, name))
+                if rule is not None and (best is None or rule[0] < best[0]):
+                    best = rule
+        return None if best is None else best[1]
+
+# (uid, gids, comm, exe) of a process from /proc/<pid>/status (effective ids; gids include the supplementary groups),
+# or None if it has exited. exe is None for kernel threads.
+def ReadProcessInfo(pid):
+    try:
+        status = ReadControlFile('/proc/%d/status'%pid)
+    except (IOError, OSError):
+        return None
+    fields = {}
+    for line in status.splitlines():
+        key, _, val = line.partition(':')
+        if key in ['Name', 'Uid', 'Gid', 'Groups']:
+            fields[key] = val.strip()
+    if 'Uid' not in fields:
+        return None
+    try:
+        exe = os.readlink('/proc/%d/exe'%pid)
+    except OSError:
+        exe = None
+    gid = int(fields['Gid'].split()[1])
+    gids = [gid]+[int(e) for e in fields.get('Groups', '').split() if int(e) != gid]
+    return int(fields['Uid'].split()[1]), gids, fields.get('Name'), exe
+
+# %u/%U (user name/uid), %g/%G (group name/gid), %p (process name) and %P (pid) in a rule destination.
+def ExpandDestination(dest, pid, uid, gid, comm):
+    if '%' not in dest:
+        return dest
+    import pwd
+    import grp
+    def name(fn, id):
+        try:
+            return fn(id)[0]
+        except KeyError:
+            return str(id)
+    for key, fn in [('%u', lambda: name(pwd.getpwuid, uid)), ('%U', lambda: str(uid)), ('%g', lambda: name(grp.getgrgid, gid)), ('%G', lambda: str(gid)), ('%p', lambda: comm or str(pid)), ('%P', lambda: str(pid))]:
+        if key in dest:
+            dest = dest.replace(key, fn())
+    return dest
+
+# moves processes to the groups their rules give. the cgroup.procs of destinations are kept open across batches,
+# so a batch costs one write(2) per pid (ClassifyPids) plus reading /proc of each pid.
+class RulesEngine(object):
+    def __init__(self, tree, rules):
+        self.tree = tree
+        self.rules = rules
+        self.fds = {}
+
+    # returns [(pid, destination or None if no rule matched, [(directory, errno)])] of the processes which were examined
+    def classify(self, pids):
+        batches = {}
+        results = []
+        for pid in pids:
+            info = ReadProcessInfo(pid)
+            if info is None or info[3] is None:
+                # exited, or a kernel thread which cannot be moved
+                continue
+            uid, gids, comm, exe = info
+            dests = self.rules.match(uid, gids, comm, exe)
+            if dests is None:
+                results.append((pid, None, []))
+                continue
+            for controllers, dest in dests:
+                dest = ExpandDestination(dest, pid, uid, gids[0], comm)
+                batches.setdefault((tuple(controllers or ()), dest), []).append(pid)
+                results.append((pid, dest, []))
+        failures = {}
+        for (controllers, dest), batch in batches.items():
+            for typ, dir in self.tree.group(dest, list(controllers)).dirs():
+                try:
+                    if dir not in self.fds:
+                        self.fds[dir] = os.open(os.path.join(dir,'cgroup.procs'), os.O_WRONLY|os.O_APPEND)
+                    failed = ClassifyPids(self.fds[dir], batch)
+                except OSError as e:
+                    failed = [(pid, e.errno) for pid in batch]
+                for pid, err in failed:
+                    if err == errno.ESRCH:
+                        continue
+                    if err in [errno.ENOENT, errno.ENODEV, errno.EBADF] and dir in self.fds:
+                        # the group was removed; reopen next time
+                        os.close(self.fds.pop(dir))
+                    failures.setdefault((pid, dest), []).append((dir, err))
+        return [(pid, dest, failures.get((pid, dest), [])) for pid, dest, _ in results]
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+def ScanPids():
+    return [int(e.name) for e in scandir('/proc') if e.name.isdigit()]
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_UID = 0x00000004
+PROC_EVENT_GID = 0x00000040
+
+# process events from the netlink proc connector (needs CAP_NET_ADMIN). read() returns the tgids which have
+# exec()ed or changed their uid/gid since the last call; all datagrams queued are read at once so that a fork storm
+# is handled in batches. if the socket buffer overflowed, every pid in /proc is returned.
+class ProcConnectorSource(object):
+    def __init__(self, rcvbuf=1<<22):
+        import socket
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_RCVBUFFORCE', 33), rcvbuf)
+        except socket.error:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((0, CN_IDX_PROC))
+        payload = struct.pack('=I', PROC_CN_MCAST_LISTEN)
+        msg = struct.pack('=IIIIHH', CN_IDX_PROC, 1, 0, 0, len(payload), 0)+payload
+        # NLMSG_DONE
+        self.sock.send(struct.pack('=IHHII', 16+len(msg), 3, 0, 0, 0)+msg)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self, timeout=None):
+        import select
+        import socket
+        try:
+            r, w, x = select.select([self.sock], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            r = []
+        pids = []
+        while r:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    return ScanPids()
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                raise
+            offset = 0
+            while offset+52 <= len(data):
+                length, = struct.unpack_from('=I', data, offset)
+                what, = struct.unpack_from('=I', data, offset+36)
+                if what in [PROC_EVENT_EXEC, PROC_EVENT_UID, PROC_EVENT_GID]:
+                    pid, tgid = struct.unpack_from('=ii', data, offset+52)
+                    pids.append(tgid)
+                offset += max(length, 16)
+        result, seen = [], set()
+        for pid in pids:
+            if pid not in seen:
+                seen.add(pid)
+                result.append(pid)
+        return result
+
+    def close(self):
+        self.sock.close()
+
+# polls /proc every interval seconds; read() returns the pids which appeared since the previous scan.
+# processes which exec() without forking are not noticed, so this is meant for testing and for hosts without
+# the proc connector.
+class ProcScanSource(object):
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.seen = set(ScanPids())
+        self.next = 0
+
+    def fileno(self):
+        return None
+
+    def read(self, timeout=None):
+        import time
+        wait = max(0, self.next-time.time())
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return []
+        time.sleep(wait)
+        self.next = time.time()+self.interval
+        pids = set(ScanPids())
+        new = sorted(pids-self.seen)
+        self.seen = pids
+        return new
+
+    def close(self):
+        pass
 
 def cgrulesengd(logout, argv):
-    raise NotImplementedError()
+    import argparse
+    import signal
+    tree = GetCgroupTree()
+    parser = argparse.ArgumentParser(prog='cgrulesengd')
+    parser.add_argument('-r', '--rules', default='/etc/cgrules.conf', metavar='<file>', help='Rules file (default: /etc/cgrules.conf)')
+    parser.add_argument('--source', choices=['auto', 'netlink', 'proc'], default='auto', help='Process events from the netlink proc connector or from polling /proc (auto: netlink if available)')
+    parser.add_argument('--interval', type=float, default=1.0, help='Interval of polling /proc in seconds')
+    parser.add_argument('-n', '--nodaemon', action='store_true', help='Accepted for compatibility; cielcg always runs in the foreground')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every classified process')
+    args = parser.parse_args(argv)
+
+    try:
+        rules = CgroupRules.load(args.rules)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('%s: %s\n'%(args.rules, e))
+        return 1
+    source = None
+    if args.source in ['auto', 'netlink']:
+        try:
+            source = ProcConnectorSource()
+        except (IOError, OSError) as e:
+            if args.source == 'netlink':
+                sys.stderr.write('cannot use the proc connector: %s\n'%e)
+                return 1
+    if source is None:
+        source = ProcScanSource(args.interval)
+    # SIGUSR2 reloads the rules like libcgroup's cgrulesengd
+    reload = []
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: reload.append(True))
+    engine = RulesEngine(tree, rules)
+    try:
+        # processes which were running before the daemon
+        pids = ScanPids()
+        while True:
+            if reload:
+                del reload[:]
+                try:
+                    engine.rules = CgroupRules.load(args.rules)
+                except (IOError, ValueError) as e:
+                    sys.stderr.write('%s: %s\n'%(args.rules, e))
+            for pid, dest, failures in engine.classify(pids):
+                if args.verbose and dest is not None:
+                    logout.write('%d %s\n'%(pid, dest))
+                for dir, err in failures:
+                    sys.stderr.write('failed to move %d to %s: %s\n'%(pid, dir, os.strerror(err)))
+            logout.flush()
+            pids = source.read()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+        engine.close()
+
+appletList = {
+    'cgexec':         cgexec,
+    'cgset':          cgset,
+    'cgget':          cgget,
+    'cgcreate':       cgcreate,
+    'cgdelete':       cgdelete,
+    'cgclassify':     cgclassify,
+    'lssubsys':       lssubsys,
+    'lscgroup':       lscgroup,
+    'cgps':           cgps,
+    'cgmove':         cgmove,
+    'cgstat':         cgstat,
+    'cgwatch':        cgwatch,
+    'cgsnapshot':     cgsnapshot,
+    'cgclear':        cgclear,
+    'cgconfigparser': cgconfigparser,
+    'cgrulesengd':    cgrulesengd,
+}
+
+# applets which replace or outlive the calling process cannot be served by the daemon, nor can those which never return
+# (requests are served one at a time, so they would block every other client)
+unservableApplets = ['cgexec', 'cgwatch', 'cgrulesengd']
+
+def IsServable(prog, args):
+    import re
+    if prog in unservableApplets:
+        return False
+    if prog == 'cgstat':
+        # cgstat samples forever unless given a count
+        return any(arg in ['-c', '--count'] or arg.startswith('--count=') or re.match(r'-c\d', arg) for arg in args)
+    return True
+
+# whether the applet arguments make it read its stdin (--stdin or a '-' file), which the client then forwards to the daemon
+def ReadsStdin(args):
+    return any(arg == '--stdin' or arg == '-' or arg.endswith('=-') for arg in args)
+
+def GetSocketPath():
+    return os.environ.get('CIELCG_SOCKET', '/run/cielcg.sock')
+
+class SocketOutput(object):
+    # frame: 1 byte channel, 4 bytes big endian length, payload
+    def __init__(self, sock, channel, bufsize=65536):
+        self.sock = sock
+        self.channel = channel
+        self.bufsize = bufsize
+        self.buf = []
+        self.buflen = 0
+    def write(self, s):
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        self.buf.append(s)
+        self.buflen += len(s)
+        if self.buflen >= self.bufsize:
+            self.flush()
+    def flush(self):
+        if self.buf:
+            data = b''.join(self.buf)
+            self.buf = []
+            self.buflen = 0
+            self.sock.sendall(struct.pack('>cI', self.channel, len(data)) + data)
+
+# served is False when the client runs the applet in-process because no daemon is listening
+def RunApplet(logout, argv, served=True):
+    try:
+        prog = os.path.basename(argv[0]).split('.')[0] if argv else ''
+        fn = appletList.get(prog)
+        if fn is None:
+            sys.stderr.write('%s applet is not available\n'%prog)
+            return 1
+        if served and not IsServable(prog, argv[1:]):
+            sys.stderr.write('%s applet cannot be run by the daemon%s\n'%(prog, ' without -c' if prog == 'cgstat' else ''))
+            return 1
+        return RunProfiled(fn, logout, argv[1:]) or 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('%s\n'%e.code)
+        return 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+
+# environment variables of the client which the served applets see instead of the daemon's
+requestEnviron = ['CIELCG_ROOT', 'CIELCG_MOUNT_CACHE', 'CIELCG_INDEX_CACHE', 'CIELCG_INDEX_TTL']
+
+# a request is a JSON object {"batch": [argv, ...], "stdin": text or null, "cwd": directory, "env": {name: value}}
+def ValidRequest(req):
+    strs = (str, type(u''))
+    if not isinstance(req, dict) or not isinstance(req.get('batch'), list):
+        return False
+    if req.get('stdin') is not None and not isinstance(req['stdin'], strs):
+        return False
+    if req.get('cwd') is not None and not isinstance(req['cwd'], strs):
+        return False
+    if not isinstance(req.get('env', {}), dict) or not all(isinstance(val, strs) for val in req.get('env', {}).values()):
+        return False
+    return all(isinstance(argv, list) and all(isinstance(arg, strs) for arg in argv) for argv in req['batch'])
+
+# moves the daemon into the working directory and environment of the client, so that relative paths (cgset -f spec,
+# --profile=trace.json, ...) and $CIELCG_ROOT resolve as they would in the client. returns the state for LeaveRequest().
+# the cgroup mount is only looked up again when the environment differs, keeping the daemon's tree (and its indexes).
+def EnterRequest(req):
+    global cgrpath, cgrver, cgrtree
+    saved = (os.getcwd(), dict((name, os.environ.get(name)) for name in requestEnviron), (cgrpath, cgrver, cgrtree))
+    if req.get('cwd'):
+        os.chdir(req['cwd'])
+    env = dict((name, req.get('env', {}).get(name)) for name in requestEnviron)
+    if env != saved[1]:
+        for name, val in env.items():
+            if val is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = val
+        cgrpath, cgrver, cgrtree = None, None, None
+    return saved
+
+def LeaveRequest(saved):
+    global cgrpath, cgrver, cgrtree
+    cwd, env, (cgrpath, cgrver, cgrtree) = saved
+    os.chdir(cwd)
+    for name, val in env.items():
+        if val is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = val
+
+def CgroupServe(sockpath):
+    import io
+    import socket
+    import json
+    if os.path.exists(sockpath):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockpath)
+        except socket.error as e:
+            if e.errno!=errno.ECONNREFUSED:
+                raise
+            os.unlink(sockpath)
+        else:
+            raise Exception('another daemon is listening on %s'%sockpath)
+        finally:
+            sock.close()
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    import signal
+    signal.signal(signal.SIGTERM, terminate)
+    GetCgroupMount()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sockpath)
+    server.listen(128)
+    try:
+        while True:
+            conn, addr = server.accept()
+            try:
+                f = conn.makefile('rb')
+                line = f.readline()
+                f.close()
+                if not line:
+                    continue
+                req = json.loads(line.decode('utf-8'))
+                if not ValidRequest(req):
+                    raise ValueError('invalid request')
+                out = SocketOutput(conn, b'1')
+                err = SocketOutput(conn, b'2')
+                # requests are served one at a time, so stdio can be swapped for the connection;
+                # the applets read the stdin forwarded by the client (if any), never the daemon's own
+                stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+                sys.stdin, sys.stdout, sys.stderr = io.StringIO(req.get('stdin') or u''), out, err
+                saved = None
+                try:
+                    try:
+                        saved = EnterRequest(req)
+                    except OSError as e:
+                        sys.stderr.write('cannot change to %s: %s\n'%(req['cwd'], e.strerror))
+                    for argv in req['batch']:
+                        status = RunApplet(out, argv) if saved is not None else 1
+                        out.flush()
+                        err.flush()
+                        conn.sendall(struct.pack('>cI', b'x', 4) + struct.pack('>i', status))
+                finally:
+                    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+                    if saved is not None:
+                        LeaveRequest(saved)
+            except (socket.error, ValueError) as e:
+                sys.stderr.write('%s\n'%e)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(sockpath)
+
+def CgroupClient(logout, argv, sockpath=None):
+    import socket
+    import json
+    stdin = None
+    if argv == ['-']:
+        import shlex
+        batch = [shlex.split(line) for line in sys.stdin if line.strip()]
+    else:
+        batch = [argv]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockpath or GetSocketPath())
+    except socket.error as e:
+        sock.close()
+        if e.errno not in [errno.ENOENT, errno.ECONNREFUSED]:
+            raise
+        # no daemon; run in-process
+        ret = 0
+        for argv in batch:
+            ret = RunApplet(logout, argv, served=False) or ret
+        return ret
+    if batch == [argv] and ReadsStdin(argv[1:]):
+        stdin = sys.stdin.read()
+        if isinstance(stdin, bytes):
+            stdin = stdin.decode('utf-8', 'replace')
+    ret = 0
+    try:
+        env = dict((name, os.environ[name]) for name in requestEnviron if name in os.environ)
+        sock.sendall(json.dumps({'batch': batch, 'stdin': stdin, 'cwd': os.getcwd(), 'env': env}).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        while True:
+            hdr = f.read(5)
+            if len(hdr) < 5:
+                break
+            channel, length = struct.unpack('>cI', hdr)
+            data = f.read(length)
+            if channel == b'1':
+                logout.write(data.decode('utf-8', 'replace'))
+            elif channel == b'2':
+                sys.stderr.write(data.decode('utf-8', 'replace'))
+            elif channel == b'x':
+                ret = struct.unpack('>i', data)[0] or ret
+        f.close()
+    finally:
+        sock.close()
+    return ret
+
+# instrumentation of the file system calls of the applets: EnableProfiler() replaces os, open and scandir of this module
+# with timed wrappers (so nothing is paid while it is off). calls are aggregated per (operation, path) with a log2 histogram
+# of their latencies in microseconds, and with trace every call is also kept as an event.
+class Profiler(object):
+    def __init__(self, trace=False):
+        import threading
+        import time
+        self.clock = getattr(time, 'perf_counter', time.time)
+        self.thread = threading.current_thread
+        self.lock = threading.Lock()
+        self.trace = trace
+        # (op, path): [calls, seconds, max seconds, bytes, errors, {bucket: calls}]
+        self.stats = {}
+        self.events = []
+        self.fds = {}
+        self.start = self.clock()
+        # (os, scandir) replaced by EnableProfiler()
+        self.saved = None
+
+    def record(self, op, path, begin, size=0, err=None):
+        dur = self.clock()-begin
+        bucket = int(dur*1000000).bit_length()
+        with self.lock:
+            stat = self.stats.get((op, path))
+            if stat is None:
+                stat = self.stats[(op, path)] = [0, 0.0, 0.0, 0, 0, {}]
+            stat[0] += 1
+            stat[1] += dur
+            stat[2] = max(stat[2], dur)
+            stat[3] += size
+            stat[4] += err is not None
+            stat[5][bucket] = stat[5].get(bucket, 0)+1
+            if self.trace:
+                self.events.append((op, path, begin-self.start, dur, size, err, self.thread().ident))
+
+    # fn(*args) recorded as op on path; size(result) is the number of bytes transferred.
+    def call(self, op, path, fn, args, size=None):
+        begin = self.clock()
+        try:
+            ret = fn(*args)
+        except (IOError, OSError) as e:
+            self.record(op, path, begin, 0, e.errno)
+            raise
+        self.record(op, path, begin, 0 if size is None else size(ret))
+        return ret
+
+    # {'ops': {op: stat}, 'files': {control file name: stat}, 'groups': {directory: stat}} where stat is
+    # {'calls', 'seconds', 'max_seconds', 'bytes', 'errors', 'histogram': {upper bound in us: calls}}.
+    def summary(self):
+        result = {'ops': {}, 'files': {}, 'groups': {}}
+        def add(table, key, stat):
+            total = table.get(key)
+            if total is None:
+                total = table[key] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0, 'errors': 0, 'histogram': {}}
+            total['calls'] += stat[0]
+            total['seconds'] += stat[1]
+            total['max_seconds'] = max(total['max_seconds'], stat[2])
+            total['bytes'] += stat[3]
+            total['errors'] += stat[4]
+            for bucket, calls in stat[5].items():
+                total['histogram'][1<<bucket] = total['histogram'].get(1<<bucket, 0)+calls
+        with self.lock:
+            stats = list(self.stats.items())
+        for (op, path), stat in stats:
+            add(result['ops'], op, stat)
+            if op in ['open', 'read', 'write']:
+                add(result['files'], os.path.basename(path), stat)
+                add(result['groups'], os.path.dirname(path), stat)
+            else:
+                add(result['groups'], path, stat)
+        return result
+
+    def write_summary(self, out, top=10):
+        summary = self.summary()
+        def percentile(histogram, calls, q):
+            seen = 0
+            for bound in sorted(histogram):
+                seen += histogram[bound]
+                if seen >= calls*q:
+                    return bound
+            return 0
+        out.write('%-8s %8s %7s %10s %10s %9s %9s %9s %10s\n'%('op', 'calls', 'errors', 'bytes', 'total_ms', 'mean_us', 'p50<=us', 'p99<=us', 'max_us'))
+        for op in sorted(summary['ops']):
+            stat = summary['ops'][op]
+            out.write('%-8s %8d %7d %10d %10.3f %9.1f %9d %9d %10.1f\n'%(op, stat['calls'], stat['errors'], stat['bytes'], stat['seconds']*1000, stat['seconds']*1000000/stat['calls'],
+                percentile(stat['histogram'], stat['calls'], 0.5), percentile(stat['histogram'], stat['calls'], 0.99), stat['max_seconds']*1000000))
+        for title, table in [('control files', summary['files']), ('groups', summary['groups'])]:
+            out.write('\nslowest %s (by total time):\n'%title)
+            for key in sorted(table, key=lambda e: -table[e]['seconds'])[:top]:
+                stat = table[key]
+                out.write('%10.3f ms %8d calls %10.1f us max  %s\n'%(stat['seconds']*1000, stat['calls'], stat['max_seconds']*1000000, key))
+        out.write('\nlatency histogram (calls per <=us):\n')
+        for op in sorted(summary['ops']):
+            histogram = summary['ops'][op]['histogram']
+            out.write('%-8s %s\n'%(op, ' '.join('%d:%d'%(bound, histogram[bound]) for bound in sorted(histogram))))
+
+    # Chrome trace event format (chrome://tracing, Perfetto) with the summary() under "summary".
+    def write_trace(self, path):
+        import json
+        events = []
+        for op, file, begin, dur, size, err, tid in self.events:
+            events.append({'name': op, 'cat': os.path.basename(file), 'ph': 'X', 'ts': begin*1000000, 'dur': dur*1000000, 'pid': os.getpid(), 'tid': tid, 'args': {'path': file, 'bytes': size, 'errno': err}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'summary': self.summary()}, f)
+
+class ProfiledOs(object):
+    def __init__(self, profiler, os):
+        self._profiler = profiler
+        self._os = os
+    def __getattr__(self, name):
+        return getattr(self._os, name)
+    def open(self, path, flags, mode=0o777):
+        fd = self._profiler.call('open', path, self._os.open, (path, flags, mode))
+        self._profiler.fds[fd] = path
+        return fd
+    def read(self, fd, n):
+        return self._profiler.call('read', self._profiler.fds.get(fd, '<fd>'), self._os.read, (fd, n), len)
+    def write(self, fd, data):
+        return self._profiler.call('write', self._profiler.fds.get(fd, '<fd>'), self._os.write, (fd, data), int)
+    def close(self, fd):
+        self._profiler.fds.pop(fd, None)
+        return self._os.close(fd)
+    def listdir(self, path):
+        return self._profiler.call('listdir', path, self._os.listdir, (path,))
+    def mkdir(self, path, mode=0o777):
+        return self._profiler.call('mkdir', path, self._os.mkdir, (path, mode))
+    def makedirs(self, path, mode=0o777, **kwargs):
+        return self._profiler.call('mkdir', path, lambda: self._os.makedirs(path, mode, **kwargs), ())
+    def rmdir(self, path):
+        return self._profiler.call('rmdir', path, self._os.rmdir, (path,))
+
+class ProfiledFile(object):
+    def __init__(self, profiler, f, path):
+        self._profiler = profiler
+        self._f = f
+        self._path = path
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._f.close()
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+    def read(self, *args):
+        return self._profiler.call('read', self._path, self._f.read, args, len)
+    def readline(self, *args):
+        return self._profiler.call('read', self._path, self._f.readline, args, len)
+    def write(self, data):
+        # flushed at once, so that the time of the write(2) (e.g. reclaim by memory.max) is not hidden in close()
+        def write():
+            self._f.write(data)
+            self._f.flush()
+            return len(data)
+        return self._profiler.call('write', self._path, write, (), int)
+
+profiler = None
+def EnableProfiler(trace=False):
+    global profiler, os, open, scandir
+    try:
+        import builtins
+    except ImportError:
+        import __builtin__ as builtins
+    if profiler is not None:
+        return profiler
+    prof = Profiler(trace)
+    realScandir = scandir
+    def profiledOpen(path, *args):
+        return ProfiledFile(prof, prof.call('open', path, builtins.open, (path,)+args), path)
+    def profiledScandir(path):
+        return prof.call('listdir', path, lambda: list(realScandir(path)), ())
+    profiler = prof
+    prof.saved = (os, realScandir)
+    os = ProfiledOs(prof, os)
+    open = profiledOpen
+    scandir = profiledScandir
+    return prof
+
+# restores the functions replaced by EnableProfiler() and returns the profiler (None if it was not enabled).
+def DisableProfiler():
+    global profiler, os, scandir
+    prof = profiler
+    if prof is not None:
+        os, scandir = prof.saved
+        del globals()['open']
+        profiler = None
+    return prof
+
+# spec is '' to write the summary to stderr, otherwise the path to write the JSON trace to.
+def ReportProfile(prof, spec):
+    if spec:
+        prof.write_trace(spec)
+    else:
+        prof.write_summary(sys.stderr)
+
+# strips the --profile[=<trace.json>] options given just after the applet name. returns (args, spec).
+def ProfileOption(args):
+    spec = None
+    while args and (args[0] == '--profile' or args[0].startswith('--profile=')):
+        spec = args[0].split('=',1)[1] if '=' in args[0] else ''
+        args = args[1:]
+    return args, spec
+
+def RunProfiled(fn, logout, args):
+    args, spec = ProfileOption(args)
+    if spec is None or profiler is not None:
+        return fn(logout, args)
+    EnableProfiler(bool(spec))
+    try:
+        return fn(logout, args)
+    finally:
+        ReportProfile(DisableProfiler(), spec)
+
+# an applet started through a symlink to this file compiles the whole script on every launch, while an import is
+# loaded from the cached bytecode. so --install writes a few lines launcher per applet importing the module instead
+# (replacing the symlinks or launchers of an earlier install), after compiling the bytecode once.
+launcherTemplate = '''#!%s
+import sys
+sys.path.insert(0, %r)
+import cielcg
+sys.exit(cielcg.main(sys.stdout, list(sys.argv)))
+'''
+
+def IsLauncher(path):
+    try:
+        with open(path) as f:
+            return 'import cielcg\n' in f.read(4096)
+    except (IOError, OSError, UnicodeDecodeError):
+        return False
+
+def InstallLaunchers(exe, dir='.'):
+    import py_compile
+    exe = os.path.realpath(exe)
+    try:
+        py_compile.compile(exe, doraise=True)
+    except (IOError, OSError):
+        # the directory is not writable; the launchers still work, compiling on each launch
+        pass
+    for appletname in appletList:
+        path = os.path.join(dir, appletname)
+        if os.path.islink(path) or IsLauncher(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o755)
+        with os.fdopen(fd, 'w') as f:
+            f.write(launcherTemplate%(sys.executable, os.path.dirname(exe)))
 
 def main(logout, argv):
-    appletList = {
-        'cgexec':         cgexec,
-        'cgset':          cgset,
-        'cgget':          cgget,
-        'cgcreate':       cgcreate,
-        'cgdelete':       cgdelete,
-        'cgclassify':     cgclassify,
-        'lssubsys':       lssubsys,
-        'lscgroup':       lscgroup,
-        # 'cgsnapshot':     cgsnapshot,
-        # 'cgclear':        cgclear,
-        # 'cgconfigparser': cgconfigparser,
-        # 'cgrulesengd':    cgrulesengd,
-    }
     prog = os.path.basename(argv[0]).split('.')[0]
     if prog not in appletList:
         exe = argv.pop(0)
@@ -613,18 +3746,27 @@ def main(logout, argv):
         if prog == '--install':
             if not os.path.isfile(exe):
                 raise Exception('exe (%s) does not exist. called by $PATH?'%exe)
-            for appletname in appletList:
-                os.symlink(exe, appletname)
+            InstallLaunchers(exe)
             return
         if prog == '--list':
             for appletname in appletList:
                 logout.write('%s\n'%appletname)
             return
+        if prog == '--serve':
+            return CgroupServe(argv[1] if len(argv)>1 else GetSocketPath())
+        if prog == '--client':
+            return CgroupClient(logout, argv[1:])
     fn = appletList.get(prog)
     if fn is None:
         sys.stderr.write('%s applet is not available\n'%prog)
     else:
-        fn(logout, argv[1:])
+        return RunProfiled(fn, logout, argv[1:])
+
+# $CIELCG_PROFILE profiles library callers (and every applet) until exit: 1 for the summary on stderr, otherwise a trace path.
+if os.environ.get('CIELCG_PROFILE'):
+    import atexit
+    EnableProfiler(os.environ['CIELCG_PROFILE'] != '1')
+    atexit.register(lambda: profiler is not None and ReportProfile(profiler, '' if os.environ['CIELCG_PROFILE'] == '1' else os.environ['CIELCG_PROFILE']))
 
 if __name__ == '__main__':
-    main(sys.stdout, list(sys.argv))
+    sys.exit(main(sys.stdout, list(sys.argv)))
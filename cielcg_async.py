@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+'''
+cielcg_async - asyncio interface to cielcg for event loop based agents (Python 3.6+)
+
+usage:
+    async with AsyncCgroupTree(jobs=4) as tree:
+        await tree.create('/job', [('memory.max', '1G')])
+        async for grp in tree.walk('/'):
+            ...
+
+the blocking cgroupfs work is run on a bounded thread pool. operations on the same group run in the order they were
+requested, while those on different groups run concurrently; cancelling an operation which has not started drops it.
+'''
+
+import asyncio
+import errno
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cielcg
+
+class AsyncCgroupTree(object):
+    # jobs threads run the blocking work; once pending operations are queued for them, further callers wait.
+    def __init__(self, tree=None, jobs=4, pending=None):
+        self.tree = tree or cielcg.GetCgroupTree()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = pending or jobs*4
+        # the semaphore is bound to the loop, so it is made by the first call
+        self.slots = None
+        # group path: future done when the last operation requested on the group has finished
+        self.tails = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # waits for the running operations and stops the threads.
+    async def close(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.executor.shutdown)
+
+    def group(self, path, controllers=None):
+        return path if isinstance(path, cielcg.Cgroup) else self.tree.group(path, controllers)
+
+    # group path of a directory of the tree (the key the operations on it are ordered by).
+    def key(self, dir):
+        rel = os.path.relpath(dir, self.tree.root).split('/')
+        if self.tree.version == 1:
+            rel = rel[1:]
+        return '/'+'/'.join(e for e in rel if e != '.')
+
+    # runs fn(*args) on the thread pool after the operations requested on the group at key have finished (key None is not
+    # ordered) and returns its result. if cancelled before fn starts, fn is not run; if cancelled while it runs, the next
+    # operation on the group still waits for it to return.
+    async def call(self, key, fn, *args):
+        loop = asyncio.get_event_loop()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pending)
+        prev = self.tails.get(key) if key is not None else None
+        done = loop.create_future()
+        if key is not None:
+            self.tails[key] = done
+        def finish(*args):
+            if not done.done():
+                done.set_result(None)
+            if self.tails.get(key) is done:
+                del self.tails[key]
+        started = None
+        try:
+            if prev is not None:
+                await asyncio.wait([prev])
+            async with self.slots:
+                started = self.executor.submit(fn, *args)
+                return await asyncio.wrap_future(started)
+        finally:
+            # the next operation on the group is released only once this one and those before it have finished
+            if started is not None and not started.done():
+                started.add_done_callback(lambda f: loop.call_soon_threadsafe(finish))
+            elif started is None and prev is not None and not prev.done():
+                prev.add_done_callback(finish)
+            else:
+                finish()
+
+    # cgcreate: creates the group (and its missing ancestors) and writes values. returns the report of CgroupTree.create_many().
+    async def create(self, path, values=(), controllers=None, mode=0o755, owner=None, task_owner=None, task_perm=None):
+        grp = self.group(path, controllers)
+        return await self.call(grp.path, self.tree.create_many, [(grp, list(values))], mode, owner, task_owner, task_perm)
+
+    # cgset: returns (written, skipped, [(key, errno)]) of Cgroup.update().
+    async def set(self, path, values, controllers=None, force=False):
+        grp = self.group(path, controllers)
+        return await self.call(grp.path, grp.update, list(values), force)
+
+    # cgget: [(name, content)] of Cgroup.values().
+    async def get(self, path, variables=None, controllers=None):
+        grp = self.group(path, controllers)
+        return await self.call(grp.path, lambda: list(grp.values(variables)))
+
+    # cgclassify: returns [(pid, errno)] which could not be moved.
+    async def classify(self, path, pids, controllers=None):
+        grp = self.group(path, controllers)
+        return await self.call(grp.path, grp.classify, list(pids))
+
+    # cgdelete: removes the group; with recursive, its descendants level by level, each directory as its own operation
+    # (so that cancelling stops between them), after killing or draining the processes as Cgroup.teardown() does.
+    # returns {'removed', 'failed': [(directory, errno)], 'seconds'}.
+    async def delete(self, path, controllers=None, recursive=False, members=None, retries=5):
+        grp = self.group(path, controllers)
+        start = time.time()
+        if not recursive:
+            def delete():
+                dirs = [dir for typ, dir in grp.dirs() if os.path.isdir(dir)]
+                grp.delete()
+                return len(dirs)
+            return {'removed': await self.call(grp.path, delete), 'failed': [], 'seconds': time.time()-start}
+        if members == 'kill':
+            await self.call(grp.path, grp.kill)
+        elif members == 'drain':
+            await self.call(grp.path, grp.drain)
+        levels = await self.call(grp.path, cielcg.TreeLevels, [dir for typ, dir in grp.dirs()])
+        removed, failures, blocked = 0, [], set()
+        async def remove(dir):
+            if dir in blocked:
+                return errno.ENOTEMPTY
+            return await self.call(self.key(dir), cielcg.RemoveDir, dir, retries)
+        for level in sorted(levels, reverse=True):
+            # a level is gathered a slice at a time, as making thousands of tasks at once stalls the loop
+            for i in range(0, len(levels[level]), self.pending):
+                dirs = levels[level][i:i+self.pending]
+                for dir, err in zip(dirs, await asyncio.gather(*[remove(dir) for dir in dirs])):
+                    if err is None:
+                        removed += 1
+                    else:
+                        failures.append((dir, err))
+                        blocked.add(os.path.dirname(dir))
+        return {'removed': removed, 'failed': failures, 'seconds': time.time()-start}
+
+    # lscgroup: yields the descendant Cgroups of path (see CgroupTree.walk()), listed chunk groups at a time on the pool.
+    async def walk(self, path='/', controllers=None, depth=None, patterns=None, chunk=256):
+        walker = self.tree.walk(path, controllers, depth, patterns)
+        while True:
+            grps = await self.call(None, lambda: list(itertools.islice(walker, chunk)))
+            if not grps:
+                return
+            for grp in grps:
+                yield grp
+
+    # cgstat: yields (time, {group: {(key, label): value}}) every interval seconds (count times, or until closed) from the
+    # control files of the groups (see cielcg.StatFiles()), read through a StatSampler.
+    async def stats(self, paths, variables=None, interval=1.0, count=None):
+        grps = [self.group(path) for path in paths]
+        sampler = await self.call(None, lambda: cielcg.StatSampler(cielcg.StatFiles(grps, variables)))
+        try:
+            n = 0
+            while count is None or n < count:
+                if n:
+                    await asyncio.sleep(interval)
+                yield time.time(), await self.call(None, sampler.sample)
+                n += 1
+        finally:
+            sampler.close()
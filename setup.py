@@ -9,7 +9,7 @@ setup(
     license='BSD',
     author='cielavenir',
     author_email='cielartisan@gmail.com',
-    py_modules=['cielcg'],
+    py_modules=['cielcg', 'cielcg_async'],
     zip_safe=False,
     include_package_data=True,
     platforms='any',
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+'''
+cielcg tests - run the applets against synthetic cgroupfs trees (see benchmark.MakeTree)
+
+usage: python -m pytest test_cielcg.py
+'''
+
+import os
+import sys
+
+import pytest
+
+import cielcg
+import benchmark
+
+class Output(object):
+    def __init__(self):
+        self.chunks = []
+    def write(self, s):
+        self.chunks.append(s)
+    def flush(self):
+        pass
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+def Run(argv):
+    out = Output()
+    ret = cielcg.main(out, list(argv))
+    return ret or 0, out.getvalue()
+
+def ReadFile(path):
+    with open(path) as f:
+        return f.read()
+
+def WriteFile(path, cont):
+    with open(path, 'w') as f:
+        f.write(cont)
+
+# the mount found by cielcg is restored after each test
+@pytest.fixture
+def v2(tmp_path, monkeypatch):
+    for name in ['cgrpath', 'cgrver', 'cgrtree']:
+        monkeypatch.setattr(cielcg, name, getattr(cielcg, name))
+    root = str(tmp_path/'cgroup')
+    os.mkdir(root)
+    benchmark.MakeTree(root, 'v2', 1)
+    WriteFile(os.path.join(root,'cgroup.subtree_control'), '\n')
+    cielcg.SetCgroupMount(root)
+    return root
+
+def test_cgset_memory_limits_with_suffixes(v2):
+    WriteFile(os.path.join(v2,'bench','memory.swap.max'), 'max\n')
+    ret, out = Run(['cgset', '-r', 'memory.limit_in_bytes=1G', '-r', 'memory.memsw.limit_in_bytes=2G', 'bench'])
+    assert ret == 0
+    assert ReadFile(os.path.join(v2,'bench','memory.max')).strip() == '1G'
+    assert ReadFile(os.path.join(v2,'bench','memory.swap.max')).strip() == str(1<<30)
+
+def test_client_relative_path(v2, tmp_path, monkeypatch):
+    import subprocess
+    import time
+    sockpath = str(tmp_path/'cielcg.sock')
+    env = dict(os.environ)
+    env.pop('CIELCG_ROOT', None)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(cielcg.__file__))
+    daemon = subprocess.Popen([sys.executable, '-m', 'cielcg', '--serve', sockpath], cwd='/', env=env)
+    try:
+        for i in range(100):
+            if os.path.exists(sockpath):
+                break
+            time.sleep(0.05)
+        workdir = tmp_path/'work'
+        workdir.mkdir()
+        WriteFile(str(workdir/'spec'), 'bench pids.max=300\n')
+        monkeypatch.chdir(str(workdir))
+        monkeypatch.setenv('CIELCG_ROOT', v2)
+        assert cielcg.CgroupClient(Output(), ['cgset', '-f', 'spec'], sockpath) == 0
+        assert ReadFile(os.path.join(v2,'bench','pids.max')).strip() == '300'
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+# an id missing from the perm block is left as it is
+@pytest.mark.skipif(os.getuid() != 0, reason='chown needs root')
+@pytest.mark.parametrize('field,expected', [('uid', (4321, 5678)), ('gid', (1234, 4321))])
+def test_cgconfigparser_perm_with_one_id(v2, tmp_path, field, expected):
+    procs = os.path.join(v2,'bench','cgroup.procs')
+    os.chown(procs, 1234, 5678)
+    conf = 'group bench {\n\tperm {\n\t\ttask {\n\t\t\t%s = 4321;\n\t\t}\n\t}\n\tpids {\n\t\tpids.max = 10;\n\t}\n}\n'%field
+    assert cielcg.LoadConfig(conf)[0]['task_owner'] == ((4321, None) if field == 'uid' else (None, 4321))
+    WriteFile(str(tmp_path/'cg.conf'), conf)
+    ret, out = Run(['cgconfigparser', '-l', str(tmp_path/'cg.conf')])
+    assert ret == 0
+    st = os.stat(procs)
+    assert (st.st_uid, st.st_gid) == expected
+
+# killing a group containing the caller must neither use cgroup.kill nor freeze it
+def test_kill_from_inside(v2):
+    import signal
+    import subprocess
+    own = cielcg.ParseProcCgroup(ReadFile('/proc/self/cgroup')).get('')
+    if own is None:
+        pytest.skip('not in a v2 hierarchy')
+    dir = os.path.join(v2, own.strip('/'))
+    cielcg.makedirs(dir, exist_ok=True)
+    child = subprocess.Popen(['sleep', '60'])
+    try:
+        WriteFile(os.path.join(dir,'cgroup.procs'), '%d\n%d\n'%(os.getpid(), child.pid))
+        WriteFile(os.path.join(dir,'cgroup.kill'), '')
+        WriteFile(os.path.join(dir,'cgroup.freeze'), '0\n')
+        grp = cielcg.GetCgroupTree().group(own)
+        assert grp.holds_caller()
+        grp.kill(timeout=0.1)
+        assert ReadFile(os.path.join(dir,'cgroup.kill')) == ''
+        assert ReadFile(os.path.join(dir,'cgroup.freeze')) == '0\n'
+        assert child.wait() == -signal.SIGKILL
+    finally:
+        if child.poll() is None:
+            child.kill()
+            child.wait()
+
+def test_cgget_json_strips_newline(v2):
+    import json
+    ret, out = Run(['cgget', '--json', '-r', 'pids.max', '-r', 'memory.stat', 'bench'])
+    assert ret == 0
+    values = json.loads(out)['values']
+    assert values['pids.max'] == 'max'
+    assert values['memory.stat'] == 'anon 1048576\nfile 0\nkernel_stack 16384'
+    # the text output keeps the contents as they are
+    ret, out = Run(['cgget', '-r', 'pids.max', 'bench'])
+    assert out == 'bench:\npids.max: max\n'
+
+def test_cgclassify_invalid_pid_fails(v2, tmp_path):
+    WriteFile(str(tmp_path/'pids'), '%d\nabc\n'%os.getpid())
+    ret, out = Run(['cgclassify', '-g', ':/bench', '--pid-file', str(tmp_path/'pids')])
+    assert ret == 1
+    assert ReadFile(os.path.join(v2,'bench','cgroup.procs')).split() == [str(os.getpid())]
+    WriteFile(str(tmp_path/'pids'), '%d\n'%os.getpid())
+    ret, out = Run(['cgclassify', '-g', ':/bench', '--pid-file', str(tmp_path/'pids')])
+    assert ret == 0